@@ -33,10 +33,391 @@ exec(s)
 # first edition of the book "Python for Computational Science".
 # The new version is created by Mario Pernici <Mario.Pernici@mi.infn.it>
 # and Hans Petter Langtangen <hpl@simula.no>. The basic idea is to
-# build a lambda function out of the string expression and define
-# self.__class__.__call__ to be this lambda function.
+# build a lambda function out of the string expression and let
+# __call__ dispatch to this lambda function. The lambda function is
+# stored in each instance (self._call) such that many StringFunction
+# objects with different formulas can coexist.
 
+import ast
+import builtins
+import math
+import operator
+import os
 import re
+import threading
+import types
+from collections import OrderedDict
+
+
+class _LRUCache(object):
+    """
+    Bounded, thread-safe cache that evicts the least recently used
+    entries, with statistics of hits, misses and evictions.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        """Return the cached object for key, or None if not cached."""
+        with self._lock:
+            try:
+                value = self._cache[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Insert value, evicting the least recently used entries."""
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            self._evict()
+
+    def resize(self, maxsize):
+        """Change the maximum number of cached entries."""
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def _evict(self):
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self, statistics=True):
+        """Remove all entries and (if statistics) reset the statistics."""
+        with self._lock:
+            self._cache.clear()
+            if statistics:
+                self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        """Return a dict with hits, misses, evictions, size and maxsize."""
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, size=len(self._cache),
+                    maxsize=self.maxsize)
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class CompileCache(_LRUCache):
+    """
+    Bounded, process-wide LRU cache of the code objects compiled
+    from StringFunction formulas.
+
+    The key is the normalized expression, the independent variables,
+    the parameter names and the identity of the globals namespace.
+    Parameter values are not part of the key (they are bound as
+    default arguments when the function object is made), so
+    constructing a repeated formula costs a dictionary lookup.
+
+    >>> from scitools.StringFunction import CompileCache
+    >>> cache = CompileCache(maxsize=2)
+    >>> cache.put('a', 1); cache.put('b', 2); cache.put('c', 3)
+    >>> cache.get('a') is None, cache.get('c')
+    (True, 3)
+    >>> info = cache.info()
+    >>> info['hits'], info['misses'], info['evictions'], info['size']
+    (1, 1, 1, 2)
+    """
+
+# process-wide cache used by all StringFunction instances:
+compile_cache = CompileCache()
+
+
+class DiskCache(object):
+    """
+    Persistent cache of the code objects compiled from StringFunction
+    formulas, shared by processes (see enable_disk_cache). Each entry
+    is a file with the marshalled code objects, named by a hash of
+    the key (expression, variables, parameter names, options and the
+    Python bytecode version). A file holds the key and a checksum of
+    the data, and a file that does not match is ignored and removed.
+    Files are written to a temporary name and renamed, so concurrent
+    writers never expose partial files. When the files take more
+    than maxbytes, the least recently used ones are removed.
+
+    The code objects are executed when loaded, so the directory must
+    only be writable by trusted users.
+    """
+
+    def __init__(self, directory, maxbytes=2**26):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.hits = self.misses = self.errors = 0
+        # estimate of the size of the files (the directory is scanned
+        # when it exceeds maxbytes, or after _scan_interval writes,
+        # since other processes write too):
+        self._nbytes = None
+        self._writes = 0
+
+    _suffix = '.sfc'
+    _scan_interval = 100
+
+    def _path(self, key):
+        import hashlib
+        name = hashlib.sha256(repr(key).encode()).hexdigest()[:40]
+        return os.path.join(self.directory, name + self._suffix)
+
+    def get(self, key):
+        """Return the cached object for key, or None if not cached."""
+        import hashlib, marshal
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        checksum, data = data[:32], data[32:]
+        try:
+            if hashlib.sha256(data).digest() != checksum:
+                raise ValueError('checksum mismatch')
+            stored_key, value = marshal.loads(data)
+            if stored_key != repr(key):
+                raise ValueError('key mismatch')
+        except (ValueError, EOFError, TypeError):
+            # corrupt file or hash collision
+            self.errors += 1
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store value (marshallable) for key."""
+        import hashlib, marshal, tempfile
+        data = marshal.dumps((repr(key), value))
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(hashlib.sha256(data).digest() + data)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            # e.g. a full disk: the cache is an optimization only
+            self.errors += 1
+            return
+        self._writes += 1
+        if self._nbytes is None or self._writes % self._scan_interval == 0:
+            self._nbytes = self._evict()
+        else:
+            self._nbytes += 32 + len(data)
+            if self._nbytes > self.maxbytes:
+                self._nbytes = self._evict()
+
+    def _entries(self):
+        """Return a list of (last use, size, path) of the cache files."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self._suffix):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:  # removed by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self):
+        """
+        Remove the least recently used files until the files take
+        at most maxbytes. Return the size of the remaining files.
+        """
+        entries = self._entries()
+        size = sum([entry[1] for entry in entries])
+        for mtime, nbytes, path in sorted(entries):
+            if size <= self.maxbytes:
+                break
+            self._remove(path)
+            size -= nbytes
+        return size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        for mtime, nbytes, path in self._entries():
+            self._remove(path)
+        self.hits = self.misses = self.errors = 0
+        self._nbytes = 0
+
+    def info(self):
+        """Return a dict with hits, misses, errors, files and bytes."""
+        entries = self._entries()
+        return dict(hits=self.hits, misses=self.misses, errors=self.errors,
+                    files=len(entries),
+                    bytes=sum([entry[1] for entry in entries]),
+                    maxbytes=self.maxbytes)
+
+
+# persistent cache consulted before compiling (None: not used):
+disk_cache = None
+
+# version of the compiled entries (part of the disk_cache keys, such
+# that entries stored by other versions are not used):
+_compiled_format = 2
+
+
+def enable_disk_cache(directory=None, maxbytes=2**26):
+    """
+    Let all StringFunction objects store and look up their compiled
+    code in a DiskCache in directory (default: the code subdirectory
+    of cache_dir), such that new processes constructing the same
+    formulas skip parsing and compilation. Return the DiskCache.
+
+    >>> import tempfile, scitools.StringFunction as sf
+    >>> cache = sf.enable_disk_cache(tempfile.mkdtemp())
+    >>> f = sf.StringFunction('1 + a*t**2', independent_variable='t', a=2)
+    >>> f(3), cache.info()['files']
+    (19, 1)
+    >>> sf.disable_disk_cache()
+    """
+    global disk_cache
+    if directory is None:
+        directory = os.path.join(cache_dir, 'code')
+    disk_cache = DiskCache(directory, maxbytes)
+    return disk_cache
+
+
+def disable_disk_cache():
+    """Stop using the persistent cache (see enable_disk_cache)."""
+    global disk_cache
+    disk_cache = None
+
+
+# argument types evaluated with the math module in vectorized mode:
+_scalar_types = (float, int)
+
+# NumPy names of the functions in math_functions (when different):
+_numpy_names = {'acos': 'arccos', 'asin': 'arcsin', 'atan': 'arctan',
+                'atan2': 'arctan2', 'pow': 'power'}
+
+def _numpy_namespace(globals_dict):
+    """
+    Return a copy of globals_dict where the math module versions of
+    the names in math_functions are replaced by NumPy ufuncs.
+    Names bound to other objects (e.g. the user's own sin function)
+    are left untouched. The copy is made for each build of a
+    function, such that it has the current names in globals_dict.
+    """
+    import math, numpy
+    namespace = dict(globals_dict)
+    for name in math_functions:
+        if namespace.get(name, getattr(math, name)) is getattr(math, name):
+            namespace[name] = getattr(numpy, _numpy_names.get(name, name))
+    # names in the code of conditional expressions (see _NumpyPrinter):
+    namespace.update(_where=numpy.where, _select=_select,
+                     _logical_and=numpy.logical_and,
+                     _logical_or=numpy.logical_or,
+                     _logical_not=numpy.logical_not)
+    return namespace
+
+
+def _select(conditions, values, default):
+    """numpy.select, also for conditions that are not bool arrays."""
+    import numpy
+    return numpy.select([numpy.asarray(c, dtype=bool) for c in conditions],
+                        values, default)
+
+
+def _quiet(function):
+    """
+    Return function evaluated without floating-point warnings (for
+    the branches of conditional expressions that are not selected).
+    """
+    import numpy
+
+    def quiet_function(*args, **kwargs):
+        with numpy.errstate(divide='ignore', invalid='ignore',
+                            over='ignore'):
+            return function(*args, **kwargs)
+    return quiet_function
+
+
+# functions in modules (StringFunction('package.module.function')),
+# key is (module name, function name):
+_module_functions = {}
+
+
+def _module_function(module, name):
+    """Return the function name in module (imported once)."""
+    try:
+        return _module_functions[(module, name)]
+    except KeyError:
+        pass
+    import importlib
+    function = getattr(importlib.import_module(module), name)
+    _module_functions[(module, name)] = function
+    return function
+
+
+def _is_iterable(value):
+    """Return True if value is an iterable, but not an array or number."""
+    import numpy
+    if isinstance(value, (numpy.ndarray, numpy.generic, str)):
+        return False
+    try:
+        iter(value)
+    except TypeError:
+        return False
+    return True
+
+
+# namespaces of unpickled StringFunction objects (key: the symbols),
+# shared such that equal formulas hit compile_cache:
+_symbol_namespaces = _LRUCache(maxsize=256)
+
+
+def _symbol_namespace(symbols, modules):
+    """
+    Return a globals dict with the symbols (dict) and the modules
+    (dict of name: module name), shared between calls with equal
+    arguments when the symbol values are hashable.
+    """
+    import importlib
+    try:
+        key = (tuple(sorted(symbols.items())), tuple(sorted(modules.items())))
+        hash(key)
+    except TypeError:  # e.g. an array value
+        key = None
+    namespace = _symbol_namespaces.get(key) if key is not None else None
+    if namespace is None:
+        namespace = dict(symbols)
+        for name, module in modules.items():
+            namespace[name] = importlib.import_module(module)
+        if key is not None:
+            _symbol_namespaces.put(key, namespace)
+    return namespace
+
+
+def _normalize_expression(expression):
+    """
+    Return expression with redundant whitespace removed (except
+    when the expression contains string literals, where whitespace
+    may be significant).
+    """
+    if "'" in expression or '"' in expression:
+        return expression.strip()
+    return ' '.join(expression.split())
+
 
 class StringFunction(object):
     """
@@ -65,6 +446,11 @@ class StringFunction(object):
     >>> f(1.2, A=2, w=1)   # can also set parameters in the call
     2.8640781719344526
 
+    >>> # parameter values are used as is (not formatted as text):
+    >>> f.set_parameters(A=1/3.)
+    >>> f(0.5*pi, w=1) == 1 + 1/3.
+    True
+
     >>> # function of two variables:
     >>> f = StringFunction('1+sin(2*x)*cos(y)', \
                            independent_variables=('x','y'))
@@ -88,6 +474,19 @@ class StringFunction(object):
     >>> f(2,1)  # [1+2*2, 1]
     [5, 1]
 
+    >>> # array arguments (NumPy ufuncs replace the math functions):
+    >>> from numpy import array
+    >>> f = StringFunction('1+sin(2*x)', vectorized=True)
+    >>> f(array([0, 0.25*pi]))
+    array([1., 2.])
+    >>> f(1.2)  # scalar arguments still use the math module
+    1.675463180551151
+
+    >>> # each instance has its own compiled formula:
+    >>> f = StringFunction('x+1'); g = StringFunction('10*x')
+    >>> f(1), g(1)
+    (2, 10)
+
     StringFunction expressions may contain fractions like 1/2 and these
     always result in float division (not integer division). Here is
     an example:
@@ -97,13 +496,29 @@ class StringFunction(object):
     >>> f(2)
     1.25
 
+    Conditional expressions (value if condition else other), with
+    comparisons and and/or/not, can be used, as well as
+    piecewise(c1, v1, c2, v2, ..., default), which is v1 where c1 is
+    true, v2 where c1 is false and c2 is true, and so on (default is
+    nan if not given). With arrays, the branches are selected by
+    numpy.where and numpy.select, and the C and Fortran code uses
+    ?: and merge:
+
+    >>> f = StringFunction('piecewise(x < 0, 0, x < 1, x**2, 1)',
+    ...                    vectorized=True)
+    >>> f(0.5), f(2)
+    (0.25, 1)
+    >>> print(f(array([-1, 0.5, 2])))
+    [0.   0.25 1.  ]
+    >>> StringFunction('sqrt(x) if x > 0 else 0')._c_expression()
+    '((x > 0.0) ? sqrt(x) : 0.0)'
 
     The string parameter can, instead of a valid Python expression,
     be a function in a file (module). The string is then the
     complete path to the function, typically of the form
     somepackage.somemodule.function_name. This functionality is useful
     when simple string formulas cannot describe the function, e.g., when
-    there are multiple if-branches inside the function expression.
+    there are loops or statements inside the function.
 
     As an example, there is a function called _test_function:
 
@@ -139,7 +554,18 @@ class StringFunction(object):
 
        TypeError: only rank-0 arrays can be converted to Python scalars.
 
-    Make something like::
+    The simplest remedy is to supply the vectorized=True argument to
+    the constructor::
+
+       f = StringFunction('cos(x)*sin(y)', independent_variables=('x', 'y'),
+                          vectorized=True)
+
+    With vectorized=True, the math functions in math_functions are
+    replaced by NumPy ufuncs when the arguments are arrays, while calls
+    with float or int arguments still use the faster math module
+    versions. The expression is compiled only once for both cases.
+
+    Alternatively, make something like::
 
        from numpy import *
        # or
@@ -160,8 +586,25 @@ class StringFunction(object):
     to allow array arguments.
 
     2) StringFunction builds a lambda function and evaluates this.
+    The lambda function is built at the first call, so constructing
+    formulas that are never called is cheap; use the validate method
+    to compile and check a formula immediately.
     You can see the lambda function as a string by accessing the
-    _lambda attribute.
+    _lambda attribute. The compiled lambda code is shared between
+    instances with the same formula, independent variables and
+    parameter names through the process-wide compile_cache
+    (see compile_cache.info() for hit/miss/eviction counts).
+    Processes can also share the compiled code through a directory
+    on disk (see enable_disk_cache).
+    With the optimize=True constructor argument, an optimized version
+    of the expression is compiled instead (see the explain method);
+    the results may then differ in the last digits.
+
+    3) With the memoize=True (or memoize=maxsize) constructor argument,
+    the values of calls with float arguments are kept in a bounded
+    cache, which pays off when an expensive formula (e.g. a function
+    in a module) is evaluated at the same points repeatedly, as in
+    adaptive ODE solvers, quadrature and root finding (see memo_info).
     """
 
     def __init__(self, expression, **kwargs):
@@ -209,25 +652,111 @@ class StringFunction(object):
         else:
             self._globals = globals()
 
+        # vectorized=True: evaluate array arguments with NumPy ufuncs
+        self._vectorized = kwargs.get('vectorized', False)
+        # optimize=True: compile an optimized version of the expression
+        self._optimize = kwargs.get('optimize', False)
+        # memoize=True or maxsize: cache the values of scalar calls
+        self._memoize = kwargs.get('memoize', False)
+        self._make_memo()
+
         self._prms = kwargs.copy()
-        try:
-            del self._prms['independent_variable']
-        except:
-            pass
-        try:
-            del self._prms['independent_variables']
-        except:
-            pass
-        try:
-            del self._prms['globals']
-        except:
-            pass
-        try:
-            # may fail if not all parameters are defined yet
-            self._build_lambda()
-        except NameError as e:
-            # print e
-            pass  # ok at this stage: parameters might be missing
+        for option in ('independent_variable', 'independent_variables',
+                       'globals', 'vectorized', 'optimize', 'memoize'):
+            try:
+                del self._prms[option]
+            except:
+                pass
+        # the lambda function is built at the first call (or by validate)
+        self._reset_compiled()
+
+    def _reset_compiled(self):
+        """Discard the compiled function (rebuilt at the next call)."""
+        # compiled lambda function for this instance (__call__ dispatches
+        # to self._call); until the lambda is built, a call builds it first
+        self._call = self._build_and_call
+        self._lambda_code = None  # code object of the lambda function
+        self._lambdas = ()  # function objects made from self._lambda_code
+        # _BlockProgram objects for evaluate and sweep (made when needed):
+        self._programs = {}
+        self._texts = {}  # kind -> (parameter names, text), see _cached_text
+        self._hoist = None  # computes parameter-only subexpressions (optimize)
+        if self._memo is not None:
+            self._memo.clear(statistics=False)
+
+    def _make_memo(self):
+        """Make the cache of values of scalar calls (memoize option)."""
+        if self._memoize:
+            maxsize = 1024 if self._memoize is True else self._memoize
+            self._memo = _LRUCache(maxsize)
+        else:
+            self._memo = None
+
+    def __getstate__(self):
+        """
+        Return the state for pickling: the expression, independent
+        variables, parameters and options, and only the global names
+        used by the formula (modules are stored by name and imported
+        again). The compiled function is not pickled, but rebuilt at
+        the first call after unpickling (through the compile caches).
+
+        >>> import pickle
+        >>> f = StringFunction('a*sin(x)', a=2, globals={'sin': sin})
+        >>> g = pickle.loads(pickle.dumps(f))
+        >>> g(pi/2), 'sin' in g._globals, 'cos' in g._globals
+        (2.0, True, False)
+        >>> x = 'large global data'
+        >>> h = StringFunction('sin(x)*cos(x)', globals=globals())
+        >>> 'large' in str(h.__getstate__())  # the global x is not pickled
+        False
+        """
+        if self._globals is globals():
+            symbols = modules = None  # this module's namespace
+        else:
+            symbols = {}
+            modules = {}
+            for name in self._global_names():
+                if name in self._globals:
+                    value = self._globals[name]
+                    if isinstance(value, types.ModuleType):
+                        modules[name] = value.__name__
+                    else:
+                        symbols[name] = value
+        return dict(f=self._f, var=self._var, prms=self._prms,
+                    function_in_module=self._function_in_module,
+                    vectorized=self._vectorized, optimize=self._optimize,
+                    memoize=self._memoize, symbols=symbols, modules=modules)
+
+    def _global_names(self):
+        """
+        Return the set of names in the formula (and in parameter
+        values that are formula strings) that may be global names,
+        i.e., all names except the independent variables and the
+        parameters.
+        """
+        names = set(re.findall(r'[A-Za-z_]\w*', self._f))
+        names.difference_update(self._var)
+        names.difference_update(self._prms)
+        for value in self._prms.values():
+            if isinstance(value, str):
+                names.update(re.findall(r'[A-Za-z_]\w*', value))
+        return names
+
+    def __setstate__(self, state):
+        self._f = state['f']
+        self._var = state['var']
+        self._prms = state['prms']
+        self._function_in_module = state['function_in_module']
+        self._vectorized = state['vectorized']
+        self._optimize = state['optimize']
+        self._memoize = state.get('memoize', False)
+        self._make_memo()
+        if state['symbols'] is None:
+            self._globals = globals()
+        else:
+            self._globals = _symbol_namespace(state['symbols'],
+                                              state['modules'])
+        self._reset_compiled()
 
     def _build_lambda(self):
         """
@@ -236,185 +765,1350 @@ class StringFunction(object):
         parameters as keyword arguments.
         The idea is due to Mario Pernici <Mario.Pernici@mi.infn.it>.
         """
-        args = ', '.join(self._var)
-        s = 'lambda self,' + args
-
-        # add parameters as keyword arguments:
-        if self._prms:
-            kwargs = ', '.join(['%s=%s' % (k, self._prms[k]) \
-                                for k in self._prms])
-            s += ', ' + kwargs
-        else:
-            kwargs = ''
-
+        self._programs = {}
         if self._function_in_module is None:
-            # insert string expression as body in the lambda function:
-            s += ': ' + self._f
-        else:
-            exec('import ' + self._function_in_module[0])
-            # let lambda call a function in a file (module):
-            s += ', module=%s: module.%s(%s, %s)' % \
-                 (self._function_in_module[0],
-                  self._function_in_module[1],
-                  args, kwargs)
-            # note: we could use self._f directly here (giving the
-            # full module path), but then we need to do import first,
-            # all this is done in the __init__ and then it is simpler
-            # to just let self_function_in_module point to the imported
-            # function
-
-        self._lambda = s  # store lambda function code; just for convenience
+            self._build_lambda_from_cache()
+            return
 
+        # a function in a file (module) is called directly if there
+        # are no parameters, otherwise through a lambda function passing
+        # the parameters (default arguments, as for string formulas)
+        # as keyword arguments
+        function = _module_function(*self._function_in_module)
+        if not self._prms:
+            self._lambda = self._f  # just for convenience
+            self._call = function
+            return
+        key = ('<module function>', self._var, tuple(self._prms))
+        compiled = compile_cache.get(key)
+        if compiled is None:
+            s = 'lambda %s, _function: _function(%s)' % (
+                ', '.join(self._var + tuple(self._prms)),
+                ', '.join(self._var +
+                          tuple(['%s=%s' % (name, name)
+                                 for name in self._prms])))
+            compiled = (s, eval(s).__code__)
+            compile_cache.put(key, compiled)
+        self._lambda, code = compiled
         try:
-            if self._function_in_module is None:
+            defaults = self._parameter_values() + (function,)
+        except NameError as e:
+            self._raise_name_error(e)
+        self._call = types.FunctionType(code, globals(), code.co_name,
+                                        defaults)
+
+    def _build_lambda_from_cache(self):
+        """
+        Make the lambda function for a string expression. The lambda
+        source takes the independent variables and the parameters as
+        positional arguments; its code object is fetched from (or
+        stored in) compile_cache, and the parameter values are bound
+        as default arguments of the function object.
+        """
+        expression = _normalize_expression(self._f)
+        key = (expression, self._var, tuple(self._prms), id(self._globals))
+        if self._optimize:
+            key += ('optimize',)
+        compiled = compile_cache.get(key)
+        persistent_cache = disk_cache
+        if compiled is None and persistent_cache is not None:
+            disk_key = self._disk_cache_key(expression)
+            compiled = persistent_cache.get(disk_key)
+            if compiled is not None:
+                compile_cache.put(key, compiled)
+        if compiled is None:
+            if self._optimize:
+                compiled = self._compile_optimized(expression)
+            if compiled is None:
+                names = self._var + tuple(self._prms)
+                s = 'lambda ' + ', '.join(names) + ': '
+                tree = _conditional_tree(expression)
+                vector_code = None
+                if tree is not None:
+                    vector_code = eval(s + _numpy_code(tree),
+                                       self._globals).__code__
+                    expression = _python_code(tree)  # (piecewise)
+                s += expression
                 try:
-                    self.__class__.__call__ = eval(s, self._globals)
+                    code = eval(s, self._globals).__code__
                 except Exception as e:
                     print("""
 Making StringFunction with formula %s failed!
 Tried to build a lambda function:\n %s""" % (self._f, s))
                     raise e
+                compiled = (s, code, None, vector_code)
+            compile_cache.put(key, compiled)
+            if persistent_cache is not None:
+                persistent_cache.put(disk_key, compiled)
+        # store lambda function code; just for convenience:
+        self._lambda, code, hoist_code, vector_code = compiled
+        self._lambda_code = code
+        self._vector_code = vector_code
+        self._hoist = None if hoist_code is None else \
+                      types.FunctionType(hoist_code, self._globals)
 
-                ## the following makes all instances have the same function :-(
-                ##StringFunction.__call__ = eval(s, self._globals)
-            else:
-                # didn't work with self._globals...and we don't need it...????
-                self.__class__.__call__ = eval(s, globals(), locals())
-                # self.__class__.__call__ = eval(s)
-                # print 'call is', self.__class__.__call__
-
+        try:
+            defaults = self._lambda_defaults()
         except NameError as e:
-            prm = str(e).split()[1]
-            raise NameError('name "%s" is not defined - if it is ' \
-                            'a parameter,\nset it in the constructor or the ' \
-                            'set_parameters method, or provide\nglobals=globals() ' \
-                            'in the constructor if "%s" is a global name in the ' \
-                            'calling code.' % (prm, prm))
-
-    def set_parameters(self, **kwargs):
-        """Set keyword parameters in the function."""
-        self._prms.update(kwargs)
-        self._build_lambda()
+            self._raise_name_error(e)
+        self._scalar_call = types.FunctionType(
+            code, self._globals, code.co_name, defaults)
+        self._lambdas = (self._scalar_call,)
+        if self._vectorized:
+            self._make_vector_call()
+            self._call = self._dispatch_call
+        else:
+            self._call = self._scalar_call
 
-    def vectorize(self, globals_dict):
+    def _disk_cache_key(self, expression):
         """
-        Allow the StringFunction object to take NumPy array
-        arguments. The calling code must have done a
-        from numpy import * or similar and send the globals()
-        dictionary as the argument globals_dict.
-        Alternatively, the globals() dictionary can be supplied
-        as a globals keyword argument to the constructor.
+        Return the key of the compiled expression in disk_cache.
+        The globals are represented by the properties the compiled
+        code depends on (whether pow is the standard function).
         """
-        self._globals = globals_dict
-        self._build_lambda()
+        import importlib.util
+        key = (importlib.util.MAGIC_NUMBER, _compiled_format, expression,
+               self._var, tuple(self._prms))
+        if self._optimize:
+            key += ('optimize',
+                    _standard_pow(self._globals.get('pow', builtins.pow)))
+        return key
 
-    def troubleshoot(self, *args, **kwargs):
+    def _compile_optimized(self, expression):
         """
-        Perform function evaluation call with lots of testing to
-        try to help the user with problems.
+        Compile the optimized version of the expression (see explain).
+        Return the source and code object of the function, the
+        code object of the lambda function computing the parameter-only
+        subexpressions (None if there are no such subexpressions), and
+        the code object of the function for NumPy arrays (None if it is
+        the same function).
+        Return None if the expression cannot be optimized.
         """
         try:
-            v = self(*args, **kwargs)
-        except TypeError as e:
-            if str(e).find('only rank-0 arrays can be converted to Python scalars') != -1:
+            tree, hoisted = self._optimized_tree(expression)
+        except ValueError:
+            return None
+        names = self._var + tuple(self._prms) + \
+                tuple([name for name, subtree in hoisted])
+        s = _function_source('_formula', names, tree)
+        namespace = {}
+        exec(s, self._globals, namespace)
+        vector_code = None
+        if _has_conditionals(tree):
+            vector_namespace = {}
+            exec(_function_source('_formula', names, tree, _NumpyPrinter()),
+                 self._globals, vector_namespace)
+            vector_code = vector_namespace['_formula'].__code__
+        hoist_code = None
+        if hoisted:
+            hoist_code = eval('lambda %s: (%s,)' % (
+                ', '.join(self._prms),
+                ', '.join([_python_code(subtree)
+                           for name, subtree in hoisted])),
+                self._globals).__code__
+        return s, namespace['_formula'].__code__, hoist_code, vector_code
 
-                print('\nThe call resulted in the exception TypeError:')
-                print(e)
+    def _optimized_tree(self, expression):
+        """
+        Return the optimized tree of the expression and the list of
+        (name, subtree) for the parameter-only subtrees replaced by
+        names in the tree.
+        """
+        tree = _simplify(_parse(expression), self._globals)
+        return _hoist(tree, self._var)
 
-                # *args contains NumPy arrays and the operations in
-                # the string formula are not compatible
+    def explain(self):
+        """
+        Return the optimized form of the formula, as used with the
+        optimize=True constructor argument. Numbers are folded and
+        small integer powers are replaced by multiplications.
+        Subexpressions with parameters only (_p0, _p1, ...) are
+        computed when the parameters are set, and common
+        subexpressions (_t0, _t1, ...) are computed once per call.
 
-                # do we have intrinsic math functions of wrong type?
-                math_funcs = False;
-                not_NumPy = False
-                for f in math_functions:
-                    if self._f.find(f) != -1:
-                        math_funcs = True
-                        if str(type(f))[7:-2] != 'ufunc':
-                            not_NumPy = True
-                        break
-                if math_funcs and not_NumPy:
-                    print('\nThis message is caused by using scalar math\n' \
-                          'functions (like %s) with array arguments.\n' \
-                          'Make some\nfrom numarray import *\n' \
-                          'or similar in the calling code and ' \
-                          'supply the globals=globals() constructor\n' \
-                          'argument when creating the StringFunction instance.' \
-                          % f)
-                else:
-                    print('Internal error - this should not happen...')
+        >>> f = StringFunction('1+A*sin(2*pi*w*x)+sin(2*pi*w*x)**2',
+        ...                    A=1, w=1, optimize=True)
+        >>> print(f.explain())
+        _p0 = 2*pi*w
+        _t0 = sin(_p0*x)
+        return 1+A*_t0+_t0*_t0
+        >>> f(0.25)
+        3.0
+        """
+        tree, hoisted = self._optimized_tree(_normalize_expression(self._f))
+        lines = ['%s = %s' % (name, _python_code(subtree))
+                 for name, subtree in hoisted]
+        return '\n'.join(lines + _cse_lines(tree))
+
+    def compile(self, backend='c'):
+        """
+        Return a CompiledFunction evaluating the formula in machine
+        code: the optimized formula (see explain) is translated to a
+        C loop over the array elements, compiled with the C compiler
+        (module variable c_compiler) and loaded with ctypes. The
+        library is cached in the directory cache_dir, so later
+        processes with the same formula (and parameter names) skip
+        compilation. Parameter values are read at call time.
+        Only math functions with a C counterpart can be used.
+
+        >>> f = StringFunction('A*x**2 + sin(w*x)', A=2, w=1)
+        >>> f_c = f.compile()
+        >>> f_c(1.0) == f(1.0)
+        True
+        >>> g = StringFunction('(x-1)**3/(1 + x*x)')  # (x-1 computed once)
+        >>> abs(g.compile()(2.0) - 0.2) < 1e-15
+        True
+        >>> StringFunction('x**n', n=3).compile()(2.0)  # n: a parameter
+        8.0
+        >>> import numpy
+        >>> x = numpy.linspace(0, 1, 5)
+        >>> numpy.allclose(f_c(x, A=3), 3*x**2 + numpy.sin(x))
+        True
+        """
+        if backend != 'c':
+            raise ValueError('unknown backend %r (only "c")' % backend)
+        return CompiledFunction(self, self._c_kernel_source())
+
+    def tabulate(self, *domain, n=None, tol=None, kind='linear',
+                 max_points=2**22, **kwargs):
+        """
+        Return a TabulatedFunction approximating the formula by
+        interpolation (kind 'linear' or 'cubic') in a table of its
+        values on a uniform grid, which is much faster than evaluating
+        an expensive formula. domain is an interval (lower, upper) for
+        each independent variable (typically one or two), n is the
+        number of grid points for each variable (a number or one number
+        per variable, default 33), and keyword arguments are parameter
+        values (the current values are used for the other parameters).
+
+        If tol is given, the grid is refined (the cells are halved)
+        until the estimated maximum absolute error (the error attribute
+        of the result) is at most tol. A ValueError is raised if this
+        would need more than max_points grid points.
+
+        >>> f = StringFunction('exp(-x)*log(1 + x**2)')
+        >>> g = f.tabulate((0, 2), tol=1e-6)
+        >>> g.n, g.error < 1e-6, abs(g(0.7) - f(0.7)) < 1e-6
+        ((1025,), True, True)
+        >>> f.tabulate((0, 2), tol=1e-6, kind='cubic').n
+        (33,)
+        >>> h = StringFunction('sin(x)*cos(a*y)',
+        ...                    independent_variables=('x', 'y'), a=1)
+        >>> h_table = h.tabulate((0, 1), (0, 2), n=(11, 21), a=2)
+        >>> h_table.values.shape, h_table.error < 0.01
+        ((11, 21), True)
+        """
+        import numpy
+        if len(domain) != len(self._var):
+            raise ValueError('need an interval (lower, upper) for each of '
+                             'the independent variables %s' % (self._var,))
+        domain = tuple([tuple(interval) for interval in domain])
+        if n is None:
+            n = 33
+        if numpy.ndim(n) == 0:  # (also NumPy integers)
+            n = (n,)*len(domain)
+        n = tuple([int(m) for m in n])
+        while True:
+            table = TabulatedFunction(self, domain, n, kind, kwargs)
+            if tol is None or table.error <= tol:
+                return table
+            n = tuple([2*m - 1 for m in n])
+            points = 1
+            for m in n:
+                points *= m
+            if points > max_points:
+                raise ValueError('the tolerance %g is not reached with '
+                                 '%s grid points (error %g)' %
+                                 (tol, table.n, table.error))
+
+    def _c_kernel_source(self):
+        """Return the C source of the array loop (see _c_kernel_source)."""
+        tree, hoisted = _hoist(_simplify(self._tree(), self._globals),
+                               self._var)
+        return _c_kernel_source(tree, hoisted, self._var, tuple(self._prms),
+                                self._globals)
+
+    def diff(self, name):
+        """
+        Return a StringFunction for the partial derivative of the
+        formula with respect to name (an independent variable or a
+        parameter). The derivative is computed symbolically from the
+        expression; the new object gets a copy of the current
+        parameter values (later set_parameters calls on this object
+        do not affect it) and the same constructor options.
+
+        >>> f = StringFunction('A*sin(w*x)', A=2, w=3)
+        >>> f.diff('x')
+        StringFunction('A*w*cos(w*x)', independent_variables=('x',), A=2, w=3)
+        >>> f.diff('w')(0.5) == 2*0.5*cos(1.5)
+        True
+        """
+        return self._derived_function(
+            _derivative(self._tree(), name))
+
+    def grad(self, wrt=None):
+        """
+        Return a StringFunction for the gradient of the formula: the
+        list of partial derivatives with respect to the names in wrt
+        (default: the independent variables; parameter names may be
+        given too). For vector fields, see jacobian.
+
+        >>> f = StringFunction('x**2*y + sin(y)', independent_variables=('x', 'y'))
+        >>> g = f.grad()
+        >>> str(g)
+        '[2*x*y, x**2+cos(y)]'
+        >>> g(1, 0)
+        [0, 2.0]
+        """
+        tree = self._tree()
+        if tree[0] == 'list':
+            raise ValueError('use jacobian for the derivatives of a vector '
+                             'field')
+        return self._derived_function(
+            ('list', tuple([_derivative(tree, name)
+                            for name in self._wrt(wrt)])))
+
+    def jacobian(self, wrt=None):
+        """
+        Return a StringFunction for the Jacobian of a vector field:
+        a list of rows with the partial derivatives of each component
+        with respect to the names in wrt (default: the independent
+        variables).
+
+        >>> f = StringFunction('[x*y, x+y**2]', independent_variables=('x', 'y'))
+        >>> J = f.jacobian()
+        >>> str(J)
+        '[[y, x], [1, 2*y]]'
+        >>> J(1, 2)
+        [[2, 1], [1, 4]]
+        """
+        tree = self._tree()
+        components = tree[1] if tree[0] == 'list' else (tree,)
+        names = self._wrt(wrt)
+        return self._derived_function(
+            ('list', tuple([('list', tuple([_derivative(component, name)
+                                            for name in names]))
+                            for component in components])))
+
+    def value_and_grad(self, wrt=None):
+        """
+        Return a StringFunction computing the list of the function
+        value and the partial derivatives (as in grad). The formulas
+        are compiled together in optimized form (see explain), so
+        subexpressions shared by the value and the derivatives are
+        computed once, which makes a value and gradient evaluation
+        much cheaper than finite differences.
+
+        >>> f = StringFunction('exp(-b*x)*sin(w*x)', b=0.5, w=2)
+        >>> print(f.value_and_grad().explain())
+        _p0 = -b
+        _t0 = exp(_p0*x)
+        _t1 = w*x
+        _t2 = sin(_t1)
+        return [_t0*_t2, _p0*_t0*_t2+_t0*w*cos(_t1)]
+        """
+        tree = self._tree()
+        if tree[0] == 'list':
+            raise ValueError('value_and_grad needs a scalar formula')
+        return self._derived_function(
+            ('list', (tree,) + tuple([_derivative(tree, name)
+                                      for name in self._wrt(wrt)])),
+            optimize=True)
+
+    def substitute(self, **replacements):
+        """
+        Return a StringFunction where names (independent variables
+        or parameters) are replaced by formulas: a keyword argument
+        name=g, with g a StringFunction, a formula string or a
+        number, inlines g in place of name. The independent
+        variables of the result are those of this function, where
+        a replaced variable is replaced by the variables of its
+        replacement (for a formula string: the variables of this
+        function occurring in it, followed by its other names that
+        are not parameters or global names). Parameters of a
+        replacement with the same name as, but another value than, a
+        parameter of this function are renamed (with a _2, _3, ...
+        suffix).
+        The result is compiled as any formula, with the options of
+        this function (e.g. optimize, vectorized).
+
+        >>> f = StringFunction('A*sin(r)', independent_variable='r', A=2)
+        >>> g = StringFunction('sqrt(x**2 + y**2)*A',
+        ...                    independent_variables=('x', 'y'), A=0.5)
+        >>> h = f.substitute(r=g)
+        >>> h
+        StringFunction('A*sin(sqrt(x**2+y**2)*A_2)', independent_variables=('x', 'y'), A=2, A_2=0.5)
+        >>> h(3, 4) == f(g(3, 4))
+        True
+        >>> f.substitute(r='2*u')
+        StringFunction('A*sin(2*u)', independent_variables=('u',), A=2)
+        """
+        tree = self._tree()
+        # the variables that remain, and the variables of each replacement:
+        new_variables = {}
+        for name, g in replacements.items():
+            if isinstance(g, StringFunction):
+                new_variables[name] = g._var
+            elif isinstance(g, str):
+                names = _names(_parse(g))
+                new_variables[name] = [var for var in self._var
+                                       if var in names] + \
+                    [var for var in re.findall(r'[A-Za-z_]\w*', g)
+                     if var in names and var not in self._var and
+                     var not in self._prms and var not in self._globals]
+        variables = []
+        for name in self._var + tuple(replacements):
+            for var in new_variables.get(name, () if name in replacements
+                                         else (name,)):
+                if var not in variables:
+                    variables.append(var)
+        parameters = dict([(name, value) for name, value in self._prms.items()
+                           if name not in replacements])
+        namespace = self._globals
+        mapping = {}
+        for name, g in replacements.items():
+            if isinstance(g, StringFunction):
+                g_tree = g._tree()
+                renaming = {}
+                for prm, value in g._prms.items():
+                    new = prm
+                    k = 1
+                    while new in variables or new in parameters and \
+                          not _same_value(parameters[new], value):
+                        k += 1
+                        new = '%s_%d' % (prm, k)
+                    parameters[new] = value
+                    if new != prm:
+                        renaming[('name', prm)] = ('name', new)
+                g_tree = _substitute(g_tree, renaming)
+                if g._globals is not namespace:
+                    namespace = dict(g._globals, **namespace)
+            elif isinstance(g, (int, float)):
+                g_tree = ('num', g)
             else:
-                print(e)
-        except NameError as e:
-            print(e)
-        else:
-            print('This call worked perfectly!')
+                g_tree = _parse(str(g))
+            mapping[('name', name)] = g_tree
+        tree = _substitute(tree, mapping)
+        parameters.update(independent_variables=tuple(variables),
+                          globals=namespace, vectorized=self._vectorized,
+                          optimize=self._optimize, memoize=self._memoize)
+        return StringFunction(_python_code(tree), **parameters)
 
-    def __str__(self):
+    def compose(self, g):
         """
-        Return the string function formula as a string, with
-        parameters substituted by their values.
+        Return the composition f(g(...)) of this function f with
+        a StringFunction g, as one formula (see substitute). If g is
+        a vector field, its components are substituted for the
+        independent variables of f (one component per variable).
 
-        The return value can be used when creating Fortran or C/C++
-        functions out of the string formula:
-        f = StringFunction('a + p*x', a=1, p=0)
-        somefile.write('double somefunc(double x) { return %s; }' % str(f))
+        >>> polar = StringFunction('[r*cos(theta), r*sin(theta)]',
+        ...                        independent_variables=('r', 'theta'))
+        >>> f = StringFunction('x*y', independent_variables=('x', 'y'))
+        >>> f.compose(polar)
+        StringFunction('r*cos(theta)*(r*sin(theta))', independent_variables=('r', 'theta'), )
         """
-        s = self._f  # formula with parameter names and indep. variables
+        g_tree = g._tree()
+        if g_tree[0] != 'list':
+            if len(self._var) != 1:
+                raise ValueError('a scalar function can only be composed '
+                                 'with a function of one variable')
+            return self.substitute(**{self._var[0]: g})
+        components = _list_shape(g_tree)[1]
+        if len(components) != len(self._var):
+            raise ValueError('%s has %d components, not %d (the number of '
+                             'independent variables in %s)' %
+                             (g._f, len(components), len(self._var), self._f))
+        replacements = {}
+        for var, component in zip(self._var, components):
+            h = g._derived_function(component)
+            replacements[var] = h
+        return self.substitute(**replacements)
 
-        # Substitute parameter names by their numerical values.
-        # Start with the most complicated parameter names
-        # Improvement by Eigil Skjaelveland <eigilhs@student.matnat.uio.no>.
-        prm_names = list(self._prms.keys())
-        prm_names.sort(key=len, reverse=1)
-        for name in prm_names:
-            s = re.sub(r'([^a-z_])' + name + '([^a-z_])',
-                       r'\1{0}\2', s).format(str(self._prms[name]))
-        return s
+    def _wrt(self, wrt):
+        if wrt is None:
+            return self._var
+        if isinstance(wrt, str):
+            return (wrt,)
+        return tuple(wrt)
 
-    def __repr__(self):
-        """Return the code required to reconstruct this instance."""
-        kwargs = ', '.join(['%s=%s' % (key, repr(value)) \
-                            for key, value in list(self._prms.items())])
-        return """StringFunction(%s, independent_variables=%s, %s)""" % \
-               (repr(self._f), repr(self._var), kwargs)
+    def _tree(self):
+        """Return the expression tree of the formula."""
+        if self._function_in_module is not None:
+            raise ValueError('%s is a function in a module, not a formula'
+                             % self._f)
+        return _parse(self._f)
 
-    # The next code generation functions work only for scalar
-    # function values, not vector values (can extend to vectors by
-    # checking if self._f has a list form, and then include the
-    # return value as an array argument in the functions).
+    def _derived_function(self, tree, **kwargs):
+        """
+        Return a StringFunction for tree with the same independent
+        variables, parameters and options as this object (options
+        can be overridden by kwargs).
+        """
+        options = dict(independent_variables=self._var,
+                       globals=self._globals, vectorized=self._vectorized,
+                       optimize=self._optimize, memoize=self._memoize)
+        options.update(kwargs)
+        options.update(self._prms)
+        return StringFunction(_python_code(tree), **options)
 
-    def _no_of_vector_components(self):
+    def _lambda_defaults(self):
         """
-        Return the number of vector components in the string
-        expression.
+        Return the default arguments of the lambda function: the
+        parameter values and (optimize) the parameter-only
+        subexpressions.
         """
-        ni = len(self._var)
-        if ni == 1:
-            return 1
-        # function of more than one variable may be a vector field:
-        args = tuple([0] * ni)  # try (0,0,...) as indep. variables
+        values = self._parameter_values()
+        if self._hoist is not None:
+            values += self._hoisted_values(values)
+        return values
+
+    def _hoisted_values(self, values):
+        """Compute the parameter-only subexpressions for parameter values."""
         try:
-            v = self(args)
-            return ni
-        except:
-            # try another argument (in case (0,0,...) caused wrong calculations:
-            args = tuple([1.105] * ni)
-            v = self(args)
-            return ni
+            return self._hoist(*values)
+        except TypeError:
+            # e.g. array parameters, use NumPy versions of math functions
+            return types.FunctionType(self._hoist.__code__, _numpy_namespace(
+                self._globals))(*values)
 
-    def Cpp_code(self, function_name='somefunc'):
+    def _hoisted_kwargs(self, kwargs):
         """
-        Dump the string expression to C++.
+        Add the parameter-only subexpressions (computed with the
+        parameter values in kwargs) to the keyword arguments of a call.
+        """
+        parameters = dict(zip(self._prms, self._parameter_values()))
+        parameters.update(kwargs)
+        hoisted = self._hoisted_values(
+            tuple([parameters[name] for name in self._prms]))
+        kwargs = kwargs.copy()
+        for i, value in enumerate(hoisted):
+            kwargs['_p%d' % i] = value
+        return kwargs
+
+    def _make_vector_call(self):
+        """
+        Make self._vector_call: the lambda function where the math
+        functions are NumPy ufuncs (same code, other globals).
+        Conditional expressions need other code, where the branches
+        are selected by numpy.where (both branches are computed, so
+        warnings from the branch that is not selected are suppressed).
+        """
+        code = self._lambda_code
+        if self._vector_code is not None:
+            code = self._vector_code
+        self._vector_call = types.FunctionType(
+            code, _numpy_namespace(self._globals), code.co_name,
+            self._scalar_call.__defaults__)
+        self._lambdas = (self._scalar_call, self._vector_call)
+        if self._vector_code is not None:
+            self._vector_call = _quiet(self._vector_call)
+
+    def _dispatch_call(self, *args, **kwargs):
+        """
+        Evaluate with math functions if all arguments are float or
+        int objects, otherwise (e.g. for arrays) with NumPy ufuncs.
+        """
+        for arg in args:
+            if type(arg) not in _scalar_types:
+                return self._vector_call(*args, **kwargs)
+        return self._scalar_call(*args, **kwargs)
+
+    def _parameter_values(self):
+        """
+        Return a tuple of the parameter values (in the order of
+        self._prms). As in the lambda source of earlier versions,
+        a string value is interpreted as an expression (e.g. 'pi').
+        """
+        return tuple([eval(v, self._globals) if isinstance(v, str) else v
+                      for v in self._prms.values()])
+
+    def _raise_name_error(self, e):
+        prm = str(e).split()[1]
+        raise NameError('name "%s" is not defined - if it is ' \
+                        'a parameter,\nset it in the constructor or the ' \
+                        'set_parameters method, or provide\nglobals=globals() ' \
+                        'in the constructor if "%s" is a global name in the ' \
+                        'calling code.' % (prm, prm))
+
+    def _build_and_call(self, *args, **kwargs):
+        """
+        Build the lambda function and evaluate it. Used as self._call
+        until the lambda function is built (at the first call, such
+        that formulas that are never called are never compiled).
+        """
+        self._build_lambda()
+        if kwargs and self._hoist is not None:
+            kwargs = self._hoisted_kwargs(kwargs)
+        return self._call(*args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        """
+        Evaluate the formula (dispatch to the compiled lambda).
+        With an out (and workspace) keyword argument, the call is
+        handled by evaluate.
+        """
+        if kwargs:
+            if 'out' in kwargs or 'workspace' in kwargs:
+                return self.evaluate(*args, **kwargs)
+            if self._hoist is not None:
+                kwargs = self._hoisted_kwargs(kwargs)
+        elif self._memo is not None:
+            return self._memo_call(args)
+        return self._call(*args, **kwargs)
+
+    def _memo_call(self, args):
+        """
+        Evaluate for the arguments args, looking up (or storing) the
+        value in the memo cache if all arguments are float objects
+        (except nan, which is never equal to a cached argument).
+        Vector field values (lists) are copied, such that changes
+        of a returned list do not change the cached value.
+
+        >>> f = StringFunction('atan2(x, -1.0)', memoize=True)
+        >>> f(0.0) == pi, f(-0.0) == -pi
+        (True, True)
+        >>> g = StringFunction('[x, y]', independent_variables=('x', 'y'),
+        ...                    memoize=True)
+        >>> v = g(1.0, 2.0); v[0] = 99
+        >>> g(1.0, 2.0)
+        [1.0, 2.0]
+        """
+        for arg in args:
+            if type(arg) is not float or arg != arg:
+                return self._call(*args)
+        key = args
+        if 0.0 in args:  # -0.0 == 0.0, but the values may differ
+            key += tuple([math.copysign(1, arg) for arg in args])
+        value = self._memo.get(key)
+        if value is None:
+            value = self._call(*args)
+            self._memo.put(key, list(value) if type(value) is list
+                           else value)
+        elif type(value) is list:
+            value = list(value)
+        return value
+
+    def memo_info(self):
+        """
+        Return a dict with the statistics of the cache of values of
+        scalar calls (memoize=True or memoize=maxsize in the
+        constructor): hits, misses, evictions, size, maxsize and
+        hit_rate. Only calls with float arguments and no keyword
+        arguments are cached, and set_parameters empties the cache.
+        Return None if the values are not cached.
+
+        >>> f = StringFunction('a*exp(-x)', a=2, memoize=100)
+        >>> values = [f(x) for x in (0.5, 1.0, 0.5, 0.5)]
+        >>> f.set_parameters(a=3)
+        >>> f(0.5) == 3*exp(-0.5)
+        True
+        >>> info = f.memo_info()
+        >>> info['hits'], info['misses'], info['size'], info['hit_rate']
+        (2, 3, 1, 0.4)
+        """
+        if self._memo is None:
+            return None
+        info = self._memo.info()
+        calls = info['hits'] + info['misses']
+        info['hit_rate'] = info['hits']/calls if calls else 0.0
+        return info
+
+    def evaluate(self, *args, out=None, workspace=None, block_size=None,
+                 threads=None, **kwargs):
+        """
+        Evaluate the formula for array arguments, block by block.
+
+        Instead of computing each operation in the formula for the
+        whole arrays (which allocates a full-size temporary array for
+        every intermediate result), the formula is evaluated for one
+        block of (block_size) elements at a time, and the intermediate
+        results are stored in a few small scratch arrays that fit in
+        the CPU cache. This reduces the memory use and is faster for
+        large arrays. Subexpressions that depend on parameters only
+        are computed once per call.
+
+        The arguments are the independent variables (arrays or
+        scalars, broadcast against each other) and optionally
+        parameter values, as in a call. The result is a float64
+        array; for vector fields the array has a leading dimension
+        for the vector components.
+
+        With threads > 1 (default: the module variable
+        evaluation_threads), the arrays are split in contiguous
+        parts that are evaluated concurrently in a thread pool
+        (NumPy ufuncs release the GIL) and written to one output
+        array.
+
+        The result is stored in out if this argument is given, and
+        the scratch arrays are taken from workspace (a Workspace
+        object) if given. With both, repeated calls with float64
+        arrays of the same shape (or scalars) as arguments do not
+        allocate any array memory. A call f(x, t, out=u) is the same
+        as f.evaluate(x, t, out=u).
+
+        Formulas that cannot be evaluated in blocks (e.g. formulas
+        calling functions that are not NumPy ufuncs, or complex
+        arguments) are evaluated for the whole arrays at once, with
+        NumPy versions of the math functions as in vectorized mode
+        (and then copied to out, if given).
+
+        >>> from numpy import linspace
+        >>> f = StringFunction('1+V*sin(w*x)*exp(-b*t)',
+        ...                    independent_variables=('x','t'),
+        ...                    V=0.1, w=1, b=0.1)
+        >>> x = linspace(0, pi/2, 3)
+        >>> f.evaluate(x, 0)
+        array([1.        , 1.07071068, 1.1       ])
+        """
+        program = self._block_program()
+        if program:
+            parameters = dict(zip(self._prms, self._parameter_values()))
+            parameters.update(kwargs)
+            result = program.evaluate(args, parameters, out=out,
+                                      workspace=workspace,
+                                      block_size=block_size,
+                                      threads=threads)
+            if result is not NotImplemented:
+                return result
+        result = self._array_call(*args, **kwargs)
+        if out is None:
+            return result
+        if isinstance(result, list):  # vector field
+            for i, component in enumerate(result):
+                out[i] = component
+        else:
+            out[...] = result
+        return out
+
+    def evaluate_parallel(self, *args, processes=None, out=None, **kwargs):
+        """
+        Evaluate the formula for array arguments (as evaluate) in a
+        pool of worker processes (default: one per CPU). The
+        (broadcast) input arrays and the result are stored in shared
+        memory (multiprocessing.shared_memory), and each worker
+        evaluates contiguous parts of them, so no array data is
+        pickled. This is faster than threads (see evaluate) when the
+        evaluation is dominated by Python code, e.g. for a function
+        in a module ('package.module.function') or a formula with
+        functions that are not NumPy ufuncs. The result is identical
+        to that of evaluate. The process pool is reused in later calls.
+
+        >>> import numpy
+        >>> f = StringFunction('sin(x)*exp(-a*x)', a=0.5)
+        >>> x = numpy.linspace(0, 1, 10001)
+        >>> r = f.evaluate_parallel(x, processes=2)
+        >>> numpy.array_equal(r, f.evaluate(x))
+        True
+
+        Functions that work for numbers only are evaluated point by
+        point in the workers:
+
+        >>> g = StringFunction('math.erf')
+        >>> r = g.evaluate_parallel(x, processes=2)
+        >>> float(r[-1]) == math.erf(1)
+        True
+        """
+        import numpy
+        from multiprocessing import shared_memory
+        if processes is None:
+            processes = os.cpu_count() or 1
+        arrays = [numpy.asarray(a) for a in args]
+        shape = numpy.broadcast_shapes(*[a.shape for a in arrays])
+        n = int(numpy.prod(shape))
+        parts = _split(n, 4*processes, 4096)
+        if processes <= 1 or len(parts) <= 1 or \
+           any([a.dtype.kind not in 'biufc' for a in arrays]):
+            return self.evaluate(*args, out=out, **kwargs)
+        component_shape, dtype = self._result_type(arrays, kwargs)
+        if dtype.kind not in 'biufc':  # cannot be stored in shared memory
+            return self.evaluate(*args, out=out, **kwargs)
+        memory = []
+        try:
+            inputs = []
+            for a in arrays:
+                if a.size == 1:
+                    inputs.append(a.reshape(()))  # sent by value
+                    continue
+                shm = shared_memory.SharedMemory(
+                    create=True, size=max(1, n*a.dtype.itemsize))
+                memory.append(shm)
+                numpy.ndarray(shape, a.dtype, shm.buf)[...] = a
+                inputs.append((shm.name, a.dtype.str))
+            shm = shared_memory.SharedMemory(
+                create=True, size=max(1, n*dtype.itemsize*
+                                      int(numpy.prod(component_shape))))
+            memory.append(shm)
+            output = (shm.name, dtype.str, component_shape)
+            pool = _process_executor(processes)
+            futures = [pool.submit(_evaluate_shared, self, inputs, output,
+                                   n, start, stop, kwargs)
+                       for start, stop in parts]
+            for future in futures:
+                future.result()
+            result = numpy.ndarray(component_shape + shape, dtype, shm.buf)
+            if out is None:
+                out = result.copy()
+            else:
+                out[...] = result
+            del result
+        finally:
+            for shm in memory:
+                shm.close()
+                shm.unlink()
+        return out
+
+    def imap(self, *iterables, prefetch=0, reuse=True, threads=None,
+             **kwargs):
+        """
+        Evaluate the formula for a stream of chunks: there is one
+        argument for each independent variable, an iterable of
+        arrays (or scalars), or a scalar used for all chunks. The
+        generator yields evaluate(x_chunk, t_chunk, ..., **kwargs)
+        for each chunk, until one of the iterables is exhausted.
+
+        With reuse=True, the results are stored in reused output
+        arrays (and scratch arrays in a Workspace), so a yielded
+        array is only valid until the next chunk is requested (copy
+        it to keep it). With prefetch > 0, the input iterables are
+        read and the chunks evaluated in a background thread, up to
+        prefetch chunks ahead of the consumer (useful when reading
+        the input waits for I/O).
+
+        >>> import numpy
+        >>> f = StringFunction('a*x + t', independent_variables=('x', 't'),
+        ...                    a=2)
+        >>> chunks = (numpy.arange(3.0) + 3*i for i in range(3))
+        >>> for u in f.imap(chunks, 1, prefetch=1):
+        ...     print(u)
+        [1. 3. 5.]
+        [ 7.  9. 11.]
+        [13. 15. 17.]
+        """
+        import itertools
+        iterators = [iter(a) if _is_iterable(a) else itertools.repeat(a)
+                     for a in iterables]
+        if len(iterators) != len(self._var):
+            raise TypeError('expected %d arguments (%s), got %d' %
+                            (len(self._var), ', '.join(self._var),
+                             len(iterators)))
+        # ring of output arrays (None: not yet allocated): a chunk may
+        # be computed while the consumer holds one array and prefetch
+        # arrays wait in the queue
+        buffers = [None]*((prefetch + 2 if prefetch > 0 else 1) if reuse
+                          else 0)
+        workspace = Workspace() if reuse else None
+
+        def compute(k, args):
+            if not reuse:
+                return self.evaluate(*args, threads=threads, **kwargs)
+            i = k % len(buffers)
+            out = buffers[i]
+            if out is not None and out.shape != self._result_shape(args):
+                out = None
+            out = self.evaluate(*args, out=out, workspace=workspace,
+                                threads=threads, **kwargs)
+            buffers[i] = out
+            return out
+
+        chunks = enumerate(zip(*iterators))
+        if prefetch <= 0:
+            for k, args in chunks:
+                yield compute(k, args)
+            return
+
+        import queue
+        results = queue.Queue(prefetch)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for k, args in chunks:
+                    item = (compute(k, args), None)
+                    while not stop.is_set():
+                        try:
+                            results.put(item, timeout=0.1)
+                            break
+                        except queue.Full:
+                            pass
+                    if stop.is_set():
+                        return
+                item = (None, StopIteration())
+            except BaseException as e:
+                item = (None, e)
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        producer = threading.Thread(target=produce, daemon=True,
+                                    name='StringFunction.imap')
+        producer.start()
+        try:
+            while True:
+                value, error = results.get()
+                if error is not None:
+                    if isinstance(error, StopIteration):
+                        return
+                    raise error
+                yield value
+        finally:
+            stop.set()  # the consumer closed the generator
+
+    def _result_shape(self, args):
+        """Return the shape of the result of evaluate for args."""
+        import numpy
+        shape = numpy.broadcast_shapes(*[numpy.shape(a) for a in args])
+        if self._function_in_module is None:
+            try:
+                return _list_shape(self._tree())[0] + shape
+            except ValueError:
+                pass
+        return self._result_type(args, {})[0] + shape
+
+    def _result_type(self, arrays, kwargs):
+        """
+        Return the shape of the vector components (() for a scalar
+        formula) and the dtype of the result of evaluate for the
+        arrays (found by evaluating the first point).
+        """
+        import numpy
+        arrays = [numpy.asarray(a).reshape(-1)[:1] for a in arrays]
+        try:
+            first = self.evaluate(*arrays, **kwargs)
+        except (TypeError, ValueError):
+            if self._block_program():
+                raise
+            first = self._point_values(arrays, kwargs)
+        return numpy.shape(first)[:-1], numpy.asarray(first).dtype
+
+    def _point_values(self, args, kwargs):
+        """
+        Evaluate the formula point by point (calls with numbers) for
+        array arguments, e.g. for functions in modules that work for
+        numbers only. The result has the shape of that of evaluate.
+        """
+        import numpy
+        arrays = numpy.broadcast_arrays(*[numpy.asarray(a) for a in args])
+        values = numpy.array([self(*point, **kwargs) for point in
+                              zip(*[a.ravel().tolist() for a in arrays])])
+        values = numpy.moveaxis(values, 0, -1)  # vector components first
+        return values.reshape(values.shape[:-1] + arrays[0].shape)
+
+    def evaluate_out_of_core(self, *args, out, progress=None, resume=True,
+                             chunk_bytes=None, threads=None, **kwargs):
+        """
+        Evaluate the formula for arrays larger than the memory.
+        The arguments are arrays, numpy.memmap arrays or names of
+        .npy files (of the shape of the result), or scalars; out is
+        the name of the .npy file for the result (float64, with a
+        leading dimension for vector components as in evaluate),
+        or a numpy.memmap array (or another array) of that shape.
+
+        The arrays are read and the result written chunk by chunk
+        (rows of the first dimension) with sequential file reads and
+        writes of about chunk_bytes (default: the module variable
+        out_of_core_bytes) per chunk, so the memory use is bounded.
+        After each chunk, progress(points_done, points) is called
+        (if given). For an output file, a checkpoint file (out +
+        '.progress') records the finished chunks; if resume is true
+        and a previous run of the same evaluation was interrupted,
+        the evaluation continues after the last finished chunk
+        (otherwise an output file name is created anew as float64).
+        Return the result (out itself if it is an array, or the file
+        opened read-only with memory mapping if out is a file name).
+
+        >>> import numpy, os, tempfile
+        >>> d = tempfile.mkdtemp()
+        >>> numpy.save(os.path.join(d, 'x.npy'), numpy.linspace(0, 1, 5))
+        >>> f = StringFunction('2*x + t', independent_variables=('x', 't'))
+        >>> f.evaluate_out_of_core(os.path.join(d, 'x.npy'), 1,
+        ...                        out=os.path.join(d, 'u.npy'))
+        memmap([1. , 1.5, 2. , 2.5, 3. ])
+        >>> u = numpy.memmap(os.path.join(d, 'u.dat'), dtype=numpy.float64,
+        ...                  mode='w+', shape=(5,))
+        >>> f.evaluate_out_of_core(os.path.join(d, 'x.npy'), 2, out=u) is u
+        True
+        >>> u
+        memmap([2. , 2.5, 3. , 3.5, 4. ])
+        """
+        import json, numpy
+        arrays = [_ArrayFile(a) if isinstance(a, (str, numpy.memmap)) or
+                  hasattr(a, '__fspath__') else numpy.asarray(a)
+                  for a in args]
+        shape = numpy.broadcast_shapes(*[a.shape for a in arrays])
+        for a in arrays:
+            if isinstance(a, _ArrayFile) and a.shape != shape:
+                raise ValueError('array %s has shape %s, not %s' %
+                                 (a.path, a.shape, shape))
+        if not shape:
+            raise ValueError('evaluate_out_of_core needs array arguments')
+        component_shape, dtype = self._result_type(
+            [a.read(0, 1) if isinstance(a, _ArrayFile) else a
+             for a in arrays], kwargs)
+        out_shape = component_shape + shape
+        rows = shape[0]
+        row_points = int(numpy.prod(shape[1:]))
+        if chunk_bytes is None:
+            chunk_bytes = out_of_core_bytes
+        chunk_rows = max(1, chunk_bytes // (8*row_points*(
+            len(arrays) + max(1, int(numpy.prod(component_shape))))))
+
+        checkpoint = None
+        start = 0
+        result = out
+        if isinstance(out, numpy.memmap) or not hasattr(out, 'shape'):
+            path = out.filename if isinstance(out, numpy.memmap) \
+                   else os.fspath(out)
+            checkpoint = path + '.progress'
+            # description of the evaluation, to check that a checkpoint
+            # belongs to it:
+            job = json.dumps([repr(self), repr(kwargs), list(out_shape)] +
+                             [a.path if isinstance(a, _ArrayFile) else
+                              _array_digest(a) for a in arrays])
+            if resume and os.path.exists(checkpoint):
+                with open(checkpoint) as f:
+                    state = json.load(f)
+                if state['job'] == job:
+                    start = state['rows']
+            if not isinstance(out, numpy.memmap) and start == 0:
+                _ArrayFile.create(out, out_shape)  # a new float64 file
+            out = _ArrayFile(out)
+            if out.shape != out_shape:
+                raise ValueError('out has shape %s, not %s' %
+                                 (out.shape, out_shape))
+        elif out.shape != out_shape:
+            raise ValueError('out has shape %s, not %s' % (out.shape,
+                                                           out_shape))
+        while start < rows:
+            stop = min(rows, start + chunk_rows)
+            chunk = [a.read(start, stop) if isinstance(a, _ArrayFile)
+                     else numpy.broadcast_to(a, shape)[start:stop]
+                     if a.ndim == len(shape) and a.shape[0] > 1 else a
+                     for a in arrays]
+            values = self.evaluate(*chunk, threads=threads, **kwargs)
+            if isinstance(out, _ArrayFile):
+                out.write(start, stop, values, len(component_shape))
+                _write_json(checkpoint, dict(job=job, rows=stop))
+            else:
+                out[(slice(None),)*len(component_shape) +
+                    (slice(start, stop),)] = values
+            start = stop
+            if progress is not None:
+                progress(stop*row_points, rows*row_points)
+        if isinstance(out, _ArrayFile):
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+            if not isinstance(result, numpy.memmap):
+                return numpy.load(out.path, mmap_mode='r')
+        return result
+
+    def _block_program(self, swept=()):
+        """
+        Return the _BlockProgram for evaluate (or for sweep, with
+        the names in swept as additional inputs), or False if the
+        formula cannot be evaluated block by block.
+        """
+        program = self._programs.get(swept)
+        if program is None:
+            program = False
+            if self._function_in_module is None:
+                try:
+                    tree = _parse(self._f)
+                    if self._optimize:
+                        tree = _simplify(tree, self._globals)
+                    program = _BlockProgram(
+                        tree, self._var + swept,
+                        tuple([name for name in self._prms
+                               if name not in swept]),
+                        _numpy_namespace(self._globals))
+                except ValueError:
+                    pass
+            self._programs[swept] = program
+        return program
+
+    def sweep(self, *args, block_size=None, threads=None, **kwargs):
+        """
+        Evaluate the formula for all combinations of parameter values.
+
+        The arguments are the independent variables (as in evaluate)
+        and parameters, where parameters given as 1D arrays (or lists)
+        are swept: each swept parameter gets its own axis in the
+        result, in front of the axes of the independent variables.
+        Scalar parameter values are used as in a call.
+
+        All combinations are computed in one pass with the block
+        evaluation engine of evaluate, where the parameters are
+        broadcast along their axes, so only the result array is of
+        full size. The result is a SweepResult object with the values
+        and the names (dims) and coordinates (coords) of the axes.
+
+        >>> from numpy import linspace
+        >>> f = StringFunction('A*sin(w*x)', A=1, w=1)
+        >>> r = f.sweep(linspace(0, pi/2, 5), A=[1, 2, 3], w=[1, 2])
+        >>> r.dims, r.shape
+        (('A', 'w', 'x'), (3, 2, 5))
+        >>> print(r.sel(A=2, w=1)[1], f(pi/8, A=3, w=2))
+        2.1213203435596424 2.1213203435596424
+        """
+        import numpy
+        swept = {}
+        for name in list(kwargs):
+            if numpy.ndim(kwargs[name]) > 0:
+                swept[name] = numpy.asarray(kwargs.pop(name))
+                if swept[name].ndim != 1:
+                    raise ValueError('swept parameter %s must be a 1D array, '
+                                     'not of shape %s' %
+                                     (name, swept[name].shape))
+        if not swept:
+            raise ValueError('no parameter values to sweep (give 1D arrays)')
+        names = tuple(swept)
+        nswept = len(names)
+        args = [numpy.asarray(arg) for arg in args]
+        shape = numpy.broadcast_shapes(*[arg.shape for arg in args])
+        sweep_shape = tuple([swept[name].size for name in names])
+
+        # parameter no. i varies along axis i, the independent
+        # variables along the last axes:
+        inputs = [arg.reshape((1,)*nswept + arg.shape) for arg in args]
+        for i, name in enumerate(names):
+            inputs.append(swept[name].reshape(
+                (1,)*i + (-1,) + (1,)*(nswept - i - 1 + len(shape))))
+
+        program = self._block_program(names)
+        values = NotImplemented
+        if program:
+            parameters = dict(zip(self._prms, self._parameter_values()))
+            parameters.update(kwargs)
+            for name in names:
+                parameters.pop(name, None)
+            values = program.evaluate(inputs, parameters,
+                                      block_size=block_size, threads=threads)
+        if values is NotImplemented:
+            # evaluate for one combination of parameters at a time:
+            values = None
+            for index in numpy.ndindex(*sweep_shape):
+                kwargs.update([(name, swept[name][i])
+                               for name, i in zip(names, index)])
+                value = self.evaluate(*args, **kwargs)
+                if isinstance(value, list):  # vector field
+                    value = numpy.array(numpy.broadcast_arrays(*value))
+                value = numpy.asarray(value)
+                components = value.shape[:value.ndim - len(shape)]
+                if values is None:
+                    values = numpy.empty(components + sweep_shape + shape,
+                                         dtype=value.dtype)
+                values[(slice(None),)*len(components) + index] = value
+
+        dims = names
+        coords = dict(swept)
+        arrays = [(name, arg) for name, arg in zip(self._var, args)
+                  if arg.ndim > 0]
+        if len(shape) == 1 and len(arrays) == 1:
+            dims += (arrays[0][0],)
+            coords[arrays[0][0]] = arrays[0][1]
+        else:
+            dims += tuple(['axis%d' % i for i in range(len(shape))])
+        if values.ndim > len(dims):
+            dims = ('component',) + dims
+        return SweepResult(values, dims, coords)
+
+    def _array_call(self, *args, **kwargs):
+        """Evaluate the formula with NumPy versions of math functions."""
+        if self._lambda_code is None:
+            if self._function_in_module is not None:
+                return self(*args, **kwargs)
+            self._build_lambda()
+        if len(self._lambdas) == 1:
+            self._make_vector_call()
+        if kwargs and self._hoist is not None:
+            kwargs = self._hoisted_kwargs(kwargs)
+        return self._vector_call(*args, **kwargs)
+
+    def validate(self):
+        """
+        Compile the formula now and check that all names in it are
+        defined, such that errors are reported here instead of at the
+        first call (the constructor and set_parameters do not compile).
+        Return self.
+
+        >>> f = StringFunction('a*sin(x)')
+        >>> f.validate()  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        NameError: name "a" is not defined - if it is a parameter,
+        ...
+        >>> f.set_parameters(a=2)
+        >>> f.validate()(pi/2)
+        2.0
+        """
+        if self._call == self._build_and_call:
+            self._build_lambda()
+        if self._function_in_module is not None:
+            return self  # the function was found by _build_lambda
+        import dis
+        for instruction in dis.get_instructions(self._lambda_code):
+            if instruction.opname in ('LOAD_GLOBAL', 'LOAD_NAME') and \
+               instruction.argval not in self._globals and \
+               not hasattr(builtins, instruction.argval):
+                self._raise_name_error(NameError(
+                    'name %s is not defined' % instruction.argval))
+        return self
+
+    def set_parameters(self, **kwargs):
+        """
+        Set keyword parameters in the function.
+
+        The parameter values are default arguments of the compiled
+        lambda function. As long as no new parameter names are
+        introduced, only these defaults are updated (no recompilation),
+        so parameter values of any type (e.g. arrays) are used as is.
+        """
+        new_names = [name for name in kwargs if name not in self._prms]
+        self._prms.update(kwargs)
+        if new_names or self._lambda_code is None:
+            self._reset_compiled()  # compiled at the next call
+        else:
+            try:
+                defaults = self._lambda_defaults()
+            except NameError as e:
+                self._raise_name_error(e)
+            for function in self._lambdas:
+                function.__defaults__ = defaults
+            if self._memo is not None:
+                self._memo.clear(statistics=False)  # values have changed
+
+    def vectorize(self, globals_dict):
+        """
+        Allow the StringFunction object to take NumPy array
+        arguments. The calling code must have done a
+        from numpy import * or similar and send the globals()
+        dictionary as the argument globals_dict.
+        Alternatively, the globals() dictionary can be supplied
+        as a globals keyword argument to the constructor.
+        """
+        self._globals = globals_dict
+        self._reset_compiled()
+
+    def troubleshoot(self, *args, **kwargs):
+        """
+        Perform function evaluation call with lots of testing to
+        try to help the user with problems.
+        """
+        try:
+            v = self(*args, **kwargs)
+        except TypeError as e:
+            if str(e).find('arrays can be converted to Python scalars') != -1:
+
+                print('\nThe call resulted in the exception TypeError:')
+                print(e)
+
+                # *args contains NumPy arrays and the operations in
+                # the string formula are not compatible
+
+                # do we have intrinsic math functions of wrong type?
+                math_funcs = False;
+                not_NumPy = False
+                for f in math_functions:
+                    if self._f.find(f) != -1:
+                        math_funcs = True
+                        if str(type(f))[7:-2] != 'ufunc':
+                            not_NumPy = True
+                        break
+                if math_funcs and not_NumPy:
+                    print('\nThis message is caused by using scalar math\n' \
+                          'functions (like %s) with array arguments.\n' \
+                          'Supply the vectorized=True constructor argument\n' \
+                          'when creating the StringFunction instance.' \
+                          % f)
+                else:
+                    print('Internal error - this should not happen...')
+            else:
+                print(e)
+        except NameError as e:
+            print(e)
+        else:
+            print('This call worked perfectly!')
+
+    def __str__(self):
+        """
+        Return the string function formula as a string, with
+        parameters substituted by their values.
+
+        The return value can be used when creating Fortran or C/C++
+        functions out of the string formula:
+        f = StringFunction('a + p*x', a=1, p=0)
+        somefile.write('double somefunc(double x) { return %s; }' % str(f))
+        """
+        # the formula is translated once to a format string with the
+        # parameter values as positional fields (see _template):
+        template = self._cached_text(
+            'str', lambda: _template(self._f, tuple(self._prms)))
+        return template.format(*map(str, self._prms.values()))
+
+    def _cached_text(self, kind, make):
+        """
+        Return the text of the given kind (e.g. 'str' or 'C') made by
+        make(). The text is made once and reused as long as the
+        parameter names are the same (the values may change).
+        """
+        names = tuple(self._prms)
+        cache = self.__dict__.setdefault('_texts', {})
+        try:
+            cached_names, text = cache[kind]
+            if cached_names == names:
+                return text
+        except KeyError:
+            pass
+        text = make()
+        cache[kind] = (names, text)
+        return text
+
+    def __repr__(self):
+        """Return the code required to reconstruct this instance."""
+        kwargs = ', '.join(['%s=%s' % (key, repr(value)) \
+                            for key, value in list(self._prms.items())])
+        return """StringFunction(%s, independent_variables=%s, %s)""" % \
+               (repr(self._f), repr(self._var), kwargs)
+
+    # The next code generation functions work only for scalar
+    # function values, not vector values, except in kernel mode
+    # (kernel=True), where the function values are stored in an
+    # output array argument.
+
+    def _no_of_vector_components(self):
+        """
+        Return the number of vector components in the string
+        expression.
+        """
+        ni = len(self._var)
+        if ni == 1:
+            return 1
+        # function of more than one variable may be a vector field:
+        args = tuple([0] * ni)  # try (0,0,...) as indep. variables
+        try:
+            v = self(args)
+            return ni
+        except:
+            # try another argument (in case (0,0,...) caused wrong calculations:
+            args = tuple([1.105] * ni)
+            v = self(args)
+            return ni
+
+    def Cpp_code(self, function_name='somefunc', kernel=False, openmp=True):
+        """
+        Dump the string expression to C++.
         In C++ we use a plain function if there are no parameters,
         otherwise we use a function object with operator() for
         the function evaluation.
+        If kernel is true, an inline function with a loop over n
+        points is made instead (see C_code).
         """
+        if kernel:
+            return self._c_kernel_code(function_name, openmp, 'inline ')
         varlist = ', '.join(['double %s' % var for var in self._var])
-        expr = self._f
-        # ** does not work in C, instead of doing sophisticated
-        # parsing and edit, provide an error message
-        self._pow_check()
+        expr = self._c_expression()
         if self._prms:
             decl = ' '.join(['double %s;' % name for name in self._prms])
             prms = ', '.join(['double %s_=%s' % (name, self._prms[name]) \
@@ -438,28 +2132,55 @@ class %(function_name)s
             s = """
 double %(function_name)s (%(varlist)s)
 { return %(expr)s; }
-"""
-        return s
+""" % vars()
+        return self._c_helpers(expr) + s
 
-    def F77_code(self, function_name='somefunc'):
+    def F77_code(self, function_name='somefunc', kernel=False, openmp=True):
         """
         Dump the string expressions as a Fortran 77 function or subroutine.
 
         Note: if pow(x,a) is used in the expression, this is
         translated to x**a by a simple regex, which may fail if
         there are function calls inside pow(.,.).
+
+        If kernel is true, a subroutine evaluating the formula in a
+        loop over n points is made,
+
+        subroutine somefunc(n, x, ..., A, ..., out)
+
+        where the independent variables are arrays x(n), the
+        parameters are scalar arguments and out(n) (out(n,k) for a
+        vector field with k components, out(n,k2,k1) for a nested
+        list of k1 lists with k2 components, i.e., the same memory
+        layout as from C_code) is the result. If openmp is
+        true, the loop is parallelized by !$omp parallel do simd.
+
+        >>> f = StringFunction('exp(-a*x)*sin(w*x)**2', a=1, w=2)
+        >>> print(f.F77_code(kernel=True))
+              subroutine somefunc(n, x, a, w, out)
+              integer n, i
+              real*8 x(n)
+              real*8 a, w
+              real*8 out(n)
+              real*8 sf_p0
+              sf_p0 = (-a)
+        !$omp parallel do simd
+              do i = 1, n
+                 out(i) = exp(sf_p0*x(i))*sin(w*x(i))**2
+              end do
+        !$omp end parallel do simd
+              return
+              end
+        <BLANKLINE>
         """
-        expr = self._f
+        if kernel:
+            return self._f77_kernel_code(function_name, openmp)
+        expr = self._cached_text('F77', self._f77_expression)
         real = 'real*8'
         varlist = ', '.join(self._var)
         varlist_decl = '\n'.join(['      %s %s' % (real, name) \
                                   for name in self._var])
         decl = '\n'.join(['      %s %s' % (real, name) for name in self._prms])
-        import re
-        if re.search(r'pow\s*\(', expr):
-            # try to replace pow(x,a) by x**a
-            expr = re.sub(r'pow\(([^,]+),([^)]+)\)', '((\g<1>)**(\g<2>))',
-                          expr)
         # set parameter values:
         setp = '\n'.join(['      %s = %s' % (name, self._prms[name]) \
                           for name in self._prms])
@@ -482,6 +2203,68 @@ C     parameters:
 """ % vars()
         return s
 
+    def _f77_expression(self):
+        """Return the formula as a Fortran expression for F77_code."""
+        expr = self._f
+        if _conditional_tree(expr) is not None:
+            # no Fortran syntax for conditional expressions, use merge
+            return self._printed_expression(
+                _FortranPrinter(namespace=self._globals))
+        # try to replace pow(x,a) by x**a
+        return _pow_call.sub(r'((\g<1>)**(\g<2>))', expr)
+
+    def _f77_kernel_code(self, function_name, openmp):
+        """Return the Fortran array loop for F77_code(kernel=True)."""
+        hoisted, temporaries, shape, components = self._kernel_parts()
+        local = _local_names(('n', 'i', 'out'), self._kernel_names(),
+                             ignore_case=True)
+        n, i, out = local['n'], local['i'], local['out']
+        printer = _FortranPrinter(namespace=self._globals)
+        for name in self._var:
+            printer.names[('name', name)] = '%s(%s)' % (name, i)
+        for name in self._prms:
+            printer.names[('name', name)] = name
+        lines = ['subroutine %s(%s)' % (function_name, ', '.join(
+            [n] + list(self._var) + list(self._prms) + [out])),
+                 'integer %s, %s' % (n, i),
+                 'real*8 %s' % ', '.join(['%s(%s)' % (name, n)
+                                          for name in self._var])]
+        if self._prms:
+            lines.append('real*8 %s' % ', '.join(self._prms))
+        lines.append('real*8 %s(%s)' % (out, ', '.join(
+            [n] + [str(length) for length in shape[::-1]])))
+        local = ['sf' + name for name, subtree in hoisted + temporaries]
+        if local:
+            lines.append('real*8 %s' % ', '.join(local))
+        for name, subtree in hoisted:
+            lines.append('sf%s = %s' % (name, printer(subtree)))
+            printer.names[('name', name)] = 'sf' + name
+        s = ''.join([_f77_statement(line) for line in lines])
+        if openmp:
+            private = ['sf' + name for name, subtree in temporaries]
+            s += '!$omp parallel do simd%s\n' % (
+                ' private(%s)' % ', '.join(private) if private else '')
+        s += _f77_statement('do %s = 1, %s' % (i, n))
+        lines = []
+        for name, subtree in temporaries:
+            lines.append('sf%s = %s' % (name, printer(subtree)))
+            printer.names[subtree] = 'sf' + name
+        # Fortran arrays are stored column by column, so out(i, k2, k1)
+        # is at the same position as out[k1-1, k2-1, i] in C:
+        indices = [()]
+        for length in shape:
+            indices = [index + (k,) for index in indices
+                       for k in range(1, length + 1)]
+        for index, component in zip(indices, components):
+            index = index[::-1]
+            lines.append('%s(%s) = %s' % (out, ', '.join(
+                [i] + [str(k) for k in index]), printer(component)))
+        s += ''.join([_f77_statement(line, '   ') for line in lines])
+        s += _f77_statement('end do')
+        if openmp:
+            s += '!$omp end parallel do simd\n'
+        return s + _f77_statement('return') + _f77_statement('end')
+
     def F77_pow(self):
         """
         Generate an F77 function pow(x,a) (x**a). In some
@@ -508,20 +2291,62 @@ C     note: it cannot be int
 """
         return s
 
-    def C_code(self, function_name='somefunc', inline=False):
+    def C_code(self, function_name='somefunc', inline=False, kernel=False,
+               openmp=True):
         """
         Dump the string expressions as a C function.
         If inline is true, the C++ inline keyword is inserted
         to make the function inline.
+
+        If kernel is true, the function evaluates the formula in a
+        loop over n points: the independent variables and the output
+        are arrays and the parameters are arguments,
+
+        void somefunc(int n, const double *x, ..., double A, ..., double *out)
+
+        Component k of a vector field at point i is stored in
+        out[k*n + i] (components of nested lists are numbered row
+        by row). If openmp is true, the loop is parallelized by
+        #pragma omp parallel for simd.
+
+        >>> f = StringFunction('[A*sin(x*y), A*cos(x*y)]',
+        ...                    independent_variables=('x', 'y'), A=1)
+        >>> print(f.C_code(kernel=True))
+        void somefunc(int n, const double *x, const double *y, double A, double *out)
+        {
+          int i;
+        #pragma omp parallel for simd
+          for (i = 0; i < n; i++) {
+            const double sf_t0 = x[i]*y[i];
+            out[i] = A*sin(sf_t0);
+            out[n + i] = A*cos(sf_t0);
+          }
+        }
+        <BLANKLINE>
+
+        Arguments and local variables that have the name of a
+        parameter or variable get the prefix sf_:
+
+        >>> print(StringFunction('x**n', n=3).C_code(kernel=True))
+        void somefunc(int sf_n, const double *x, double n, double *out)
+        {
+          int i;
+        #pragma omp parallel for simd
+          for (i = 0; i < sf_n; i++) {
+            out[i] = pow(x[i], n);
+          }
+        }
+        <BLANKLINE>
         """
+        if kernel:
+            return self._c_kernel_code(function_name, openmp,
+                                       'inline ' if inline else '')
         if inline:
             s = 'inline '
         else:
             s = ''
-        expr = self._f
-        # ** does not work in C, instead of doing sophisticated
-        # parsing and edit, provide an error message
-        self._pow_check()
+        expr = self._c_expression()
+        s = self._c_helpers(expr) + s
 
         varlist = ', '.join(['double %s' % var for var in self._var])
         s += 'double %s (%s)\n{\n' % (function_name, varlist)
@@ -536,6 +2361,82 @@ C     note: it cannot be int
         s += '  return ' + expr + ';\n}\n'
         return s
 
+    def _kernel_names(self):
+        """Return the set of names used in the kernel code."""
+        return set(self._var) | set(self._prms) | _names(self._tree())
+
+    def _kernel_parts(self):
+        """
+        Return the parts of the formula for the kernel code
+        generators: the list of (name, subtree) of the parameter-only
+        subexpressions (computed before the loop), the list of (name,
+        subtree) of the common subexpressions, the shape of a vector
+        field and the list of the components.
+        """
+        tree, hoisted = _hoist(self._tree(), self._var)
+        shape, components = _list_shape(tree)
+        return hoisted, _common_subtrees(tree), shape, components
+
+    def _c_kernel_code(self, function_name, openmp, prefix=''):
+        """Return the C/C++ array loop for C_code/Cpp_code (kernel=True)."""
+        hoisted, temporaries, shape, components = self._kernel_parts()
+        local = _local_names(('n', 'i', 'out'), self._kernel_names())
+        n, i, out = local['n'], local['i'], local['out']
+        printer = _CPrinter(namespace=self._globals)
+        for name in self._var:
+            printer.names[('name', name)] = '%s[%s]' % (name, i)
+        for name in self._prms:
+            printer.names[('name', name)] = name
+        args = ['int ' + n] + ['const double *%s' % name
+                               for name in self._var] \
+               + ['double %s' % name for name in self._prms] + \
+               ['double *' + out]
+        header = '%svoid %s(' % (prefix, function_name)
+        s = header + _wrap(', '.join(args), 79 - len(header),
+                           ' '*len(header)) + ')\n{\n'
+        for name, subtree in hoisted:
+            s += '  const double sf%s = %s;\n' % (name, printer(subtree))
+            printer.names[('name', name)] = 'sf' + name
+        s += '  int %s;\n' % i
+        if openmp:
+            s += '#pragma omp parallel for simd\n'
+        s += '  for (%s = 0; %s < %s; %s++) {\n' % (i, i, n, i)
+        for name, subtree in temporaries:
+            s += '    const double sf%s = %s;\n' % (name, printer(subtree))
+            printer.names[subtree] = 'sf' + name
+        for k, component in enumerate(components):
+            s += '    %s[%s%s] = %s;\n' % (
+                out, {0: '', 1: n + ' + '}.get(k, '%d*%s + ' % (k, n)), i,
+                printer(component))
+        s += '  }\n}\n'
+        return self._c_helpers(s) + s
+
+    def _c_expression(self):
+        """
+        Return the formula as a C expression (** is translated to pow).
+
+        >>> StringFunction('A*x**2 - 1', A=2)._c_expression()
+        'A*pow(x, 2.0)-1.0'
+        >>> StringFunction('myfn(x) + 1')._c_expression()  # user's C function
+        'myfn(x)+1.0'
+        >>> StringFunction('math.e*x**2')._c_expression()
+        Traceback (most recent call last):
+        ...
+        SyntaxError: use pow(a,b) instead of a**b in the expression
+        math.e*x**2
+        (since you demand translation to C/C++)
+        """
+        return self._cached_text('C', self._c_expression_text)
+
+    def _c_expression_text(self):
+        try:
+            return self._printed_expression(
+                _CPrinter(namespace=self._globals))
+        except ValueError:
+            # e.g. module attributes: the formula as it is (if valid C)
+            self._pow_check()
+            return self._f
+
     def _pow_check(self):
         """
         Raise a SyntaxError exception if the ** power operator is used
@@ -546,28 +2447,2259 @@ C     note: it cannot be int
                 'use pow(a,b) instead of a**b in the expression' \
                 '\n%s\n(since you demand translation to C/C++)' % self._f)
 
+    def _printed_expression(self, printer):
+        """Return the formula translated by printer (names as they are)."""
+        for name in tuple(self._var) + tuple(self._prms):
+            printer.names[('name', name)] = name
+        return printer(self._tree())
 
-def _doctest():
-    # noinspection PyUnresolvedReferences
-    import doctest, StringFunction
-    return doctest.testmod(StringFunction)
+    def _c_helpers(self, expr):
+        """Return the definitions of helper functions used in expr."""
+        if 'sf_mod(' in expr:
+            return _c_preamble.split('\n', 2)[2]
+        return ''
 
 
-def _demo():
-    from math import pi
-    f = StringFunction('a+b*sin(x)', a=1, b=4)
-    print(f(2))
-    f.set_parameters(a=-1, b=pi)
-    print(f(1))
-    print('internals:', str(f), repr(f), f._lambda, f._prms)
-    f = StringFunction('amp*sin(a*t)*exp(-6.211*x)',
-                       independent_variables=('x', 't'))
-    f.set_parameters(amp=0.1, a=1)
-    print(f(0, pi / 2.0, a=2))
-    print('internals:', str(f), repr(f), f._lambda, f._prms)
-    print(f.C_code())
-    print(f.Cpp_code())
-    print(f.F77_code())
+class StringFunctionGroup(object):
+    """
+    A set of formulas of the same independent variables, evaluated
+    together. The formulas are compiled into one function (and one
+    block program for arrays, see StringFunction.evaluate), so the
+    input arrays are traversed once for all formulas and
+    subexpressions shared by several formulas are computed once.
+
+    The formulas are given as a dict (name: formula string or
+    StringFunction) or as keyword arguments of the form name=formula
+    in the formulas dict; the other keyword arguments are as for
+    StringFunction (independent_variables, globals, parameters).
+    Parameters of StringFunction members, and the global names (e.g.
+    functions) of members with their own globals, are included. A
+    call returns a dict with the value of each formula.
+
+    >>> g = StringFunctionGroup(dict(
+    ...     rho='rho0*exp(-b*t)*(1 + x)', mu='mu0*exp(-b*t)',
+    ...     q=StringFunction('[x*t, -exp(-b*t)]',
+    ...                      independent_variables=('x', 't'))),
+    ...     independent_variables=('x', 't'), rho0=1000, mu0=1e-3, b=0)
+    >>> v = g(0.5, 1)
+    >>> v['rho'], v['mu'], v['q']
+    (1500.0, 0.001, [0.5, -1.0])
+    >>> import numpy
+    >>> r = g.evaluate(numpy.linspace(0, 1, 3), 1.0)
+    >>> r['rho'], r['q'].shape
+    (array([1000., 1500., 2000.]), (2, 3))
+    >>> print(g.explain())
+    _p0 = -b
+    _t0 = exp(_p0*t)
+    return [rho0*_t0*(1+x), mu0*_t0, x*t, -_t0]
+    >>> def cube(x):
+    ...     return x**3
+    >>> g = StringFunctionGroup(dict(
+    ...     u=StringFunction('cube(x)', globals={'cube': cube}), v='sin(x)'))
+    >>> g(0.0)
+    {'u': 0.0, 'v': 0.0}
+    """
+
+    def __init__(self, formulas, **kwargs):
+        self.names = tuple(formulas)
+        variables = kwargs.pop('independent_variables', None)
+        if 'independent_variable' in kwargs:
+            variables = (kwargs.pop('independent_variable'),)
+        elif isinstance(variables, str):
+            variables = (variables,)
+        namespace = kwargs.pop('globals', None)
+        if namespace is None:
+            namespace = globals()
+        symbols = {}  # global names of members with other namespaces
+        parameters = {}
+        self._shapes = []  # component shape of each formula
+        leaves = []
+        for name in self.names:
+            formula = formulas[name]
+            if isinstance(formula, StringFunction):
+                if variables is None:
+                    variables = formula._var
+                elif formula._var != tuple(variables):
+                    raise ValueError('formula %s has the independent '
+                                     'variables %s, not %s' %
+                                     (name, formula._var, variables))
+                if formula._globals is not namespace:
+                    for symbol in formula._global_names():
+                        if symbol not in formula._globals:
+                            continue
+                        value = formula._globals[symbol]
+                        if symbols.get(symbol, value) is not value:
+                            raise ValueError('different values of the '
+                                             'global name %s in the '
+                                             'formulas' % symbol)
+                        symbols[symbol] = value
+                for prm, value in formula._prms.items():
+                    if prm in parameters and parameters[prm] is not value \
+                       and parameters[prm] != value:
+                        raise ValueError('different values of the parameter'
+                                         ' %s in the formulas' % prm)
+                    parameters[prm] = value
+                tree = formula._tree()
+            else:
+                tree = _parse(str(formula))
+            shape, components = _list_shape(tree)
+            self._shapes.append(shape)
+            leaves.extend(components)
+        parameters.update(kwargs)
+        if symbols:
+            namespace = dict(namespace, **symbols)
+        # all formula components as one vector field:
+        self._function = StringFunction(
+            _python_code(('list', tuple(leaves))),
+            independent_variables=variables or ('x',), globals=namespace,
+            vectorized=True, optimize=True, **parameters)
+
+    def __call__(self, *args, **kwargs):
+        """
+        Return a dict with the values of the formulas (array
+        arguments are handled by evaluate).
+        """
+        for arg in args:
+            if type(arg) not in _scalar_types:
+                return self.evaluate(*args, **kwargs)
+        return self._split(self._function(*args, **kwargs))
+
+    def evaluate(self, *args, **kwargs):
+        """
+        Return a dict with the values of the formulas for array
+        arguments, computed in one pass over the arrays (see
+        StringFunction.evaluate, which takes the same keyword
+        arguments). The values are views of one array with all the
+        components; with the out argument, this array is out (of
+        shape (number of components,) + shape of the arrays).
+        """
+        return self._split(self._function.evaluate(*args, **kwargs))
+
+    def _split(self, values):
+        """
+        Return a dict with the values of each formula, from the list
+        or array (first dimension) of the values of all components.
+        """
+        result = {}
+        i = 0
+        for name, shape in zip(self.names, self._shapes):
+            n = 1
+            for length in shape:
+                n *= length
+            components = values[i:i+n]
+            if isinstance(components, list):
+                result[name] = _nested_list(components, shape)
+            else:
+                result[name] = components.reshape(shape + values.shape[1:])
+            i += n
+        return result
+
+    def set_parameters(self, **kwargs):
+        """Set parameters of the formulas (see StringFunction)."""
+        self._function.set_parameters(**kwargs)
+
+    def explain(self):
+        """Return the optimized code of all the formulas (see
+        StringFunction.explain)."""
+        return self._function.explain()
+
+    def __repr__(self):
+        return 'StringFunctionGroup(%s)' % ', '.join(self.names)
+
+
+def _nested_list(values, shape):
+    """Return the flat list values as a nested list of the given shape."""
+    if not shape:
+        return values[0]
+    size = len(values) // shape[0]
+    return [_nested_list(values[i*size:(i+1)*size], shape[1:])
+            for i in range(shape[0])]
+
+
+# ---------------------------------------------------------------------------
+# Expression trees
+#
+# A string formula is parsed (by the ast module) into a tree of tuples:
+#
+#   ('num', value)                  int or float number
+#   ('name', name)                  independent variable, parameter or
+#                                   global name
+#   ('call', name, (arg, ...))      function call
+#   ('binop', op, left, right)      op is '+', '-', '*', '/', '//', '%', '**'
+#   ('unary', op, operand)          op is '-' or '+'
+#   ('list', (item, ...))           vector field (items may be lists)
+#   ('compare', op, left, right)    op is '<', '<=', '>', '>=', '==', '!='
+#   ('logic', op, (operand, ...))   op is 'and' or 'or'
+#   ('if', condition, value, else)  conditional expression
+#
+# ('unary', 'not', operand) is logical negation, and chained comparisons
+# (a < b < c) become ('logic', 'and', ...). piecewise(c1, v1, c2, v2,
+# ..., default) is translated to nested 'if' trees.
+#
+# Equal subexpressions are equal tuples, so common subexpressions are
+# found by using the trees as dictionary keys.
+# ---------------------------------------------------------------------------
+
+_binary_operators = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*',
+                     ast.Div: '/', ast.FloorDiv: '//', ast.Mod: '%',
+                     ast.Pow: '**'}
+_unary_operators = {ast.USub: '-', ast.UAdd: '+', ast.Not: 'not'}
+_compare_operators = {ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>=',
+                      ast.Eq: '==', ast.NotEq: '!='}
+_logic_operators = {ast.And: 'and', ast.Or: 'or'}
+
+
+def _parse(expression):
+    """
+    Return the tree of a string expression. ValueError is raised
+    if the expression contains Python constructs that trees do not
+    support (strings, attributes, subscripts, keyword arguments, ...).
+    """
+    try:
+        node = ast.parse(expression.strip(), mode='eval').body
+    except SyntaxError as e:
+        raise ValueError('cannot parse %s: %s' % (expression, e))
+    return _tree(node)
+
+
+def _tree(node):
+    """Translate an ast node to a tree."""
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return ('num', node.value)
+    if isinstance(node, ast.Name):
+        return ('name', node.id)
+    if isinstance(node, ast.BinOp) and type(node.op) in _binary_operators:
+        return ('binop', _binary_operators[type(node.op)],
+                _tree(node.left), _tree(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _unary_operators:
+        return ('unary', _unary_operators[type(node.op)], _tree(node.operand))
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+       and not node.keywords:
+        args = tuple([_tree(arg) for arg in node.args])
+        if node.func.id == 'piecewise':
+            return _piecewise(args)
+        return ('call', node.func.id, args)
+    if isinstance(node, ast.Compare) and \
+       all([type(op) in _compare_operators for op in node.ops]):
+        operands = [_tree(node.left)] + [_tree(c) for c in node.comparators]
+        comparisons = tuple([('compare', _compare_operators[type(op)],
+                              operands[i], operands[i+1])
+                             for i, op in enumerate(node.ops)])
+        if len(comparisons) == 1:
+            return comparisons[0]
+        return ('logic', 'and', comparisons)
+    if isinstance(node, ast.BoolOp):
+        return ('logic', _logic_operators[type(node.op)],
+                tuple([_tree(value) for value in node.values]))
+    if isinstance(node, ast.IfExp):
+        return ('if', _tree(node.test), _tree(node.body), _tree(node.orelse))
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return ('list', tuple([_tree(item) for item in node.elts]))
+    raise ValueError('%s is not supported in StringFunction expression trees'
+                     % type(node).__name__)
+
+
+def _piecewise(args):
+    """
+    Return the tree of piecewise(c1, v1, c2, v2, ..., default): v1 if
+    c1 is true, else v2 if c2 is true, ..., else default (nan if
+    there is an even number of arguments).
+    """
+    if len(args) < 2:
+        raise ValueError('piecewise needs (condition, value) pairs')
+    if len(args) % 2 == 0:
+        args += (('num', float('nan')),)
+    tree = args[-1]
+    for i in range(len(args) - 3, -1, -2):
+        tree = ('if', args[i], args[i+1], tree)
+    return tree
+
+
+def _has_conditionals(tree):
+    """Return True if tree has conditional or logical operations."""
+    kind = tree[0]
+    if kind in ('if', 'compare', 'logic') or \
+       (kind == 'unary' and tree[1] == 'not'):
+        return True
+    return any([_has_conditionals(subtree) for subtree in _subtrees(tree)])
+
+
+# tokens of a formula for _template: strings, numbers, attributes
+# (.name) and names
+_token_pattern = re.compile(r'''"[^"]*"|'[^']*'|(?:\d+\.?\d*|\.\d+)'''
+                            r'(?:[eE][+-]?\d+)?|\.?[A-Za-z_]\w*')
+
+# pow(x,a) calls (without nested calls) for F77_code:
+_pow_call = re.compile(r'pow\(([^,]+),([^)]+)\)')
+
+
+def _template(expression, names):
+    """
+    Return expression as a format string where each name in names
+    is replaced by the field {i}, i being the index of the name, such
+    that str.format with the values of the names substitutes them in
+    one pass. Names in numbers (1e5), strings and attributes (math.e)
+    are not replaced.
+
+    >>> _template('a*x + b*exp(-a) + 1e5*math.e', ('a', 'b', 'e'))
+    '{0}*x + {1}*exp(-{0}) + 1e5*math.e'
+    """
+    fields = dict([(name, '{%d}' % i) for i, name in enumerate(names)])
+    # braces in the expression must be doubled in a format string:
+    expression = expression.replace('{', '{{').replace('}', '}}')
+    parts = []
+    start = 0
+    for match in _token_pattern.finditer(expression):
+        if match.group() in fields:
+            parts.append(expression[start:match.start()])
+            parts.append(fields[match.group()])
+            start = match.end()
+    parts.append(expression[start:])
+    return ''.join(parts)
+
+
+# a formula without these has no conditionals (checked before parsing):
+_conditional_pattern = re.compile(r'[<>]|==|!=|\b(if|and|or|not|piecewise)\b')
+
+
+def _conditional_tree(expression):
+    """
+    Return the tree of expression if it has conditional or logical
+    operations (that must be translated for NumPy), otherwise None.
+    """
+    if not _conditional_pattern.search(expression):
+        return None
+    try:
+        tree = _parse(expression)
+    except ValueError:
+        return None
+    return tree if _has_conditionals(tree) else None
+
+
+def _eager_subtrees(tree):
+    """
+    Return the operands of tree that are always evaluated in Python
+    (not the branches of a conditional or the operands after the first
+    of and/or).
+    """
+    if tree[0] == 'if':
+        return tree[1:2]
+    if tree[0] == 'logic':
+        return tree[2][:1]
+    return _subtrees(tree)
+
+
+def _names(tree, names=None):
+    """Return the set of names (not function names) in tree."""
+    if names is None:
+        names = set()
+    kind = tree[0]
+    if kind == 'name':
+        names.add(tree[1])
+    elif kind != 'num':
+        for subtree in _subtrees(tree):
+            _names(subtree, names)
+    return names
+
+
+def _subtrees(tree):
+    """Return the operands/arguments of tree."""
+    kind = tree[0]
+    if kind in ('binop', 'unary', 'compare'):
+        return tree[2:]
+    if kind in ('call', 'list', 'logic'):
+        return tree[-1]
+    if kind == 'if':
+        return tree[1:]
+    return ()
+
+
+def _substitute(tree, mapping):
+    """Return tree with the subtrees in the dict mapping replaced."""
+    if tree in mapping:
+        return mapping[tree]
+    return _map_subtrees(tree, lambda subtree: _substitute(subtree, mapping))
+
+
+def _same_value(a, b):
+    """Return True if a and b are the same parameter value."""
+    try:
+        return a is b or bool(a == b)
+    except ValueError:  # e.g. arrays
+        return False
+
+
+def _list_shape(tree):
+    """
+    Return the shape of a (nested) list tree (() if tree is not a
+    list) and the list of its items (row by row).
+    """
+    if tree[0] != 'list':
+        return (), [tree]
+    shapes = []
+    items = []
+    for item in tree[1]:
+        shape, subitems = _list_shape(item)
+        shapes.append(shape)
+        items.extend(subitems)
+    if len(set(shapes)) > 1:
+        raise ValueError('the items of a vector field must have equal shapes')
+    return (len(tree[1]),) + (shapes[0] if shapes else ()), items
+
+
+def _map_subtrees(tree, function):
+    """Return tree with function applied to its operands/arguments."""
+    kind = tree[0]
+    if kind in ('binop', 'unary', 'compare'):
+        return tree[:2] + tuple([function(subtree) for subtree in tree[2:]])
+    if kind in ('call', 'logic'):
+        return (kind, tree[1], tuple([function(arg) for arg in tree[2]]))
+    if kind == 'list':
+        return (kind, tuple([function(item) for item in tree[1]]))
+    if kind == 'if':
+        return (kind,) + tuple([function(subtree) for subtree in tree[1:]])
+    return tree
+
+
+# operations on numbers (for folding):
+_operator_functions = {'+': operator.add, '-': operator.sub,
+                       '*': operator.mul, '/': operator.truediv,
+                       '//': operator.floordiv, '%': operator.mod,
+                       '**': operator.pow}
+_unary_operator_functions = {'-': operator.neg, '+': operator.pos,
+                             'not': operator.not_}
+
+# integer powers up to this one are replaced by multiplications:
+_max_power = 8
+
+
+def _simplify(tree, namespace):
+    """
+    Fold operations on numbers and replace integer powers x**n and
+    pow(x,n), 2 <= n <= _max_power, by multiplications.
+    namespace is the globals dict used to check that pow is the
+    standard (math, builtin or NumPy) power function.
+
+    >>> _python_code(_simplify(_parse('x**3 + pow(y, 2) - 2*3*x'), {}))
+    'x*x*x+y*y-6*x'
+    >>> _python_code(_simplify(_parse('pow(y, 2)'), {'pow': math.pow}))
+    '1.0*(y*y)'
+    """
+    tree = _fold(_map_subtrees(
+        tree, lambda subtree: _simplify(subtree, namespace)))
+    kind = tree[0]
+    to_float = False
+    if kind == 'binop' and tree[1] == '**':
+        base, exponent = tree[2:]
+    elif kind == 'call' and tree[1] == 'pow' and len(tree[2]) == 2 and \
+         _standard_pow(namespace.get('pow', builtins.pow)):
+        base, exponent = tree[2]
+        # math.pow returns a float also for int arguments:
+        to_float = namespace.get('pow', builtins.pow) is math.pow and \
+                   not (base[0] == 'num' and type(base[1]) is float)
+    else:
+        return tree
+    if exponent[0] == 'num' and type(exponent[1]) is int and \
+       2 <= exponent[1] <= _max_power:
+        product = _power_product(base, exponent[1])
+        if to_float:  # (1.0*y is y for a float y)
+            return ('binop', '*', ('num', 1.0), product)
+        return product
+    return tree
+
+
+def _fold(tree):
+    """Return ('num', value) if tree is an operation on numbers."""
+    kind = tree[0]
+    if kind in ('binop', 'unary') and \
+       all([subtree[0] == 'num' for subtree in tree[2:]]):
+        try:
+            if kind == 'binop':
+                value = _operator_functions[tree[1]](tree[2][1], tree[3][1])
+            else:
+                value = _unary_operator_functions[tree[1]](tree[2][1])
+        except (ArithmeticError, ValueError):
+            return tree
+        if (type(value) is float and math.isfinite(value)) or \
+           (type(value) is int and abs(value) < 2**53):
+            return ('num', value)
+    return tree
+
+
+def _standard_pow(function):
+    """Return True if function is the builtin, math or NumPy pow."""
+    return function is builtins.pow or \
+           getattr(function, '__module__', None) in ('math', 'numpy')
+
+
+def _power_product(base, n):
+    """Return the tree of base**n as products (by repeated squaring)."""
+    if n == 1:
+        return base
+    if n % 2 == 0:
+        half = _power_product(base, n//2)
+        return ('binop', '*', half, half)
+    return ('binop', '*', _power_product(base, n - 1), base)
+
+
+# Construction of trees with simplification of operations on 0 and 1
+# (used to keep derivatives readable):
+
+def _is_number(tree, value):
+    return tree[0] == 'num' and tree[1] == value
+
+
+def _add(a, b):
+    if _is_number(a, 0):
+        return b
+    if _is_number(b, 0):
+        return a
+    if b[0] == 'unary' and b[1] == '-':
+        return _sub(a, b[2])
+    return _fold(('binop', '+', a, b))
+
+
+def _sub(a, b):
+    if _is_number(b, 0):
+        return a
+    if _is_number(a, 0):
+        return _neg(b)
+    if b[0] == 'unary' and b[1] == '-':
+        return _add(a, b[2])
+    return _fold(('binop', '-', a, b))
+
+
+def _neg(a):
+    if a[0] == 'unary' and a[1] == '-':
+        return a[2]
+    return _fold(('unary', '-', a))
+
+
+def _mul(a, b):
+    if _is_number(a, 0) or _is_number(b, 0):
+        return ('num', 0)
+    if _is_number(a, 1):
+        return b
+    if _is_number(b, 1):
+        return a
+    if _is_number(a, -1):
+        return _neg(b)
+    if _is_number(b, -1):
+        return _neg(a)
+    if b[0] == 'num' and a[0] != 'num':
+        a, b = b, a  # numbers first: 2*x rather than x*2
+    if b[0] == 'binop' and b[1] == '*':
+        return _mul(_mul(a, b[2]), b[3])  # a*b*c rather than a*(b*c)
+    return _fold(('binop', '*', a, b))
+
+
+def _div(a, b):
+    if _is_number(a, 0):
+        return ('num', 0)
+    if _is_number(b, 1):
+        return a
+    if a[0] == 'unary' and a[1] == '-':
+        return _neg(_div(a[2], b))
+    return _fold(('binop', '/', a, b))
+
+
+def _pow(a, b):
+    if _is_number(b, 1):
+        return a
+    if _is_number(b, 0):
+        return ('num', 1)
+    return ('binop', '**', a, b)
+
+
+def _call(name, *args):
+    return ('call', name, args)
+
+
+# derivatives of functions of one argument u, as functions of u
+# (the result is multiplied by the derivative of u):
+_function_derivatives = {
+    'sin': lambda u: _call('cos', u),
+    'cos': lambda u: _neg(_call('sin', u)),
+    'tan': lambda u: _add(('num', 1), _pow(_call('tan', u), ('num', 2))),
+    'exp': lambda u: _call('exp', u),
+    'log': lambda u: _div(('num', 1), u),
+    'log10': lambda u: _div(('num', 1), _mul(u, _call('log', ('num', 10)))),
+    'sqrt': lambda u: _div(('num', 1), _mul(('num', 2), _call('sqrt', u))),
+    'asin': lambda u: _div(('num', 1), _call(
+        'sqrt', _sub(('num', 1), _pow(u, ('num', 2))))),
+    'acos': lambda u: _neg(_div(('num', 1), _call(
+        'sqrt', _sub(('num', 1), _pow(u, ('num', 2)))))),
+    'atan': lambda u: _div(('num', 1), _add(('num', 1), _pow(u, ('num', 2)))),
+    'sinh': lambda u: _call('cosh', u),
+    'cosh': lambda u: _call('sinh', u),
+    'tanh': lambda u: _sub(('num', 1), _pow(_call('tanh', u), ('num', 2))),
+    'fabs': lambda u: _div(u, _call('fabs', u)),
+    'abs': lambda u: _div(u, _call('abs', u)),
+    'ceil': lambda u: ('num', 0),
+    'floor': lambda u: ('num', 0),
+}
+
+
+def _derivative(tree, name):
+    """
+    Return the tree of the derivative of tree with respect to name.
+
+    >>> _python_code(_derivative(_parse('A*sin(w*x) + x**3'), 'x'))
+    'A*w*cos(w*x)+3*x**2'
+    >>> _python_code(_derivative(_parse('x*gamma(a) + min(a, 1)'), 'x'))
+    'gamma(a)'
+    """
+    kind = tree[0]
+    if kind == 'num':
+        return ('num', 0)
+    if kind == 'name':
+        return ('num', 1 if tree[1] == name else 0)
+    if kind == 'list':
+        return ('list', tuple([_derivative(item, name) for item in tree[1]]))
+    if kind in ('compare', 'logic') or (kind == 'unary' and tree[1] == 'not'):
+        return ('num', 0)  # piecewise constant
+    if kind == 'if':
+        return ('if', tree[1], _derivative(tree[2], name),
+                _derivative(tree[3], name))
+    if kind == 'unary':
+        d = _derivative(tree[2], name)
+        return _neg(d) if tree[1] == '-' else d
+    if kind == 'call':
+        function, args = tree[1], tree[2]
+        if name not in _names(tree):
+            return ('num', 0)  # e.g. gamma(a) or min(a, 1)
+        if function == 'pow' and len(args) == 2:
+            return _derivative(('binop', '**') + args, name)
+        if function == 'atan2' and len(args) == 2:
+            y, x = args
+            return _div(_sub(_mul(x, _derivative(y, name)),
+                             _mul(y, _derivative(x, name))),
+                        _add(_mul(x, x), _mul(y, y)))
+        if function not in _function_derivatives or len(args) != 1:
+            raise ValueError('cannot differentiate %s' % _python_code(tree))
+        du = _derivative(args[0], name)
+        if _is_number(du, 0):
+            return du
+        return _mul(du, _function_derivatives[function](args[0]))
+    # binary operators:
+    op, a, b = tree[1:]
+    da = _derivative(a, name)
+    db = _derivative(b, name)
+    if op == '+':
+        return _add(da, db)
+    if op == '-':
+        return _sub(da, db)
+    if op == '*':
+        return _add(_mul(da, b), _mul(a, db))
+    if op == '/':
+        if _is_number(db, 0):
+            return _div(da, b)
+        return _div(_sub(_mul(da, b), _mul(a, db)), _mul(b, b))
+    if op == '**':
+        if _is_number(db, 0):  # a**b, b constant
+            return _mul(_mul(b, _pow(a, _fold(
+                ('binop', '-', b, ('num', 1))))), da)
+        if _is_number(da, 0):  # a**b, a constant
+            return _mul(_mul(tree, _call('log', a)), db)
+        return _mul(tree, _add(_mul(db, _call('log', a)),
+                               _div(_mul(b, da), a)))
+    if op == '//':
+        return ('num', 0)
+    if op == '%':
+        return _sub(da, _mul(('binop', '//', a, b), db))
+    raise ValueError('cannot differentiate %s' % _python_code(tree))
+
+
+def _hoist(tree, variables):
+    """
+    Replace the subtrees of tree that do not depend on the variables
+    (i.e. depend on parameters, globals and numbers only) by the names
+    _p0, _p1, ... Return the new tree and the list of (name, subtree).
+    """
+    hoisted = []
+    names = {}
+
+    def visit(subtree):
+        kind = subtree[0]
+        if kind in ('num', 'name'):
+            return subtree
+        if kind != 'list' and _names(subtree).isdisjoint(variables):
+            if subtree not in names:
+                names[subtree] = '_p%d' % len(hoisted)
+                hoisted.append((names[subtree], subtree))
+            return ('name', names[subtree])
+        if kind == 'if':  # the branches are evaluated only when selected
+            return (kind, visit(subtree[1])) + subtree[2:]
+        if kind == 'logic':
+            return (kind, subtree[1],
+                    (visit(subtree[2][0]),) + subtree[2][1:])
+        return _map_subtrees(subtree, visit)
+
+    return visit(tree), hoisted
+
+
+def _cse_lines(tree, printer=None):
+    """
+    Return lines of Python code evaluating tree, where subexpressions
+    occurring more than once are assigned to temporary variables
+    _t0, _t1, ... The last line is a return statement.
+
+    >>> _cse_lines(_parse('sin(x)*sin(x) + sin(x)'))
+    ['_t0 = sin(x)', 'return _t0*_t0+_t0']
+    """
+    if printer is None:
+        printer = _PythonPrinter()
+    lines = []
+    for name, subtree in _common_subtrees(tree):
+        lines.append('%s = %s' % (name, printer(subtree)))
+        printer.names[subtree] = name
+    return lines + ['return ' + printer(tree)]
+
+
+def _common_subtrees(tree):
+    """
+    Return the list of (name, subtree) for the subtrees occurring more
+    than once in tree (innermost first, named _t0, _t1, ...).
+    """
+    # count the uses of each distinct subtree (the subtrees of a
+    # repeated subtree are counted once):
+    uses = {}
+
+    def count(subtree):
+        # (subexpressions of conditional branches are not computed in
+        # advance, since they may be invalid when not selected)
+        for operand in _eager_subtrees(subtree):
+            if operand[0] not in ('num', 'name'):
+                uses[operand] = uses.get(operand, 0) + 1
+                if uses[operand] == 1:
+                    count(operand)
+    count(tree)
+
+    temporaries = []
+    visited = set()
+
+    def assign(subtree):
+        # assign the repeated subtrees, innermost first
+        if subtree in visited or subtree[0] in ('num', 'name'):
+            return
+        visited.add(subtree)
+        for operand in _subtrees(subtree):
+            assign(operand)
+        if uses.get(subtree, 0) > 1:
+            temporaries.append(('_t%d' % len(temporaries), subtree))
+    assign(tree)
+    return temporaries
+
+
+def _function_source(name, args, tree, printer=None):
+    """
+    Return the source of a function name(args) returning the value
+    of tree (with common subexpressions computed once).
+    """
+    return 'def %s(%s):\n' % (name, ', '.join(args)) + \
+           ''.join(['    %s\n' % line for line in _cse_lines(tree, printer)])
+
+
+# operator precedence in Python (atoms have precedence 20):
+_precedence = {'if': 1, 'or': 2, 'and': 3, 'not': 4, 'compare': 5,
+               '+': 10, '-': 10, '*': 11, '/': 11, '//': 11, '%': 11,
+               'unary': 12, '**': 13}
+
+
+class _PythonPrinter(object):
+    """
+    Translate a tree to Python code, with parentheses only where
+    they are needed.
+    """
+
+    def __init__(self, names=None):
+        # subtrees to be printed as names (e.g. temporary variables):
+        self.names = {} if names is None else names
+
+    def __call__(self, tree):
+        return self.code(tree)[0]
+
+    def code(self, tree):
+        """Return the code of tree and the precedence of its operator."""
+        if tree in self.names:
+            return self.names[tree], 20
+        return getattr(self, '_' + tree[0])(tree)
+
+    def _num(self, tree):
+        if not math.isfinite(tree[1]):
+            return "float('%r')" % tree[1], 20
+        return repr(tree[1]), (_precedence['unary'] if tree[1] < 0 else 20)
+
+    def _name(self, tree):
+        return tree[1], 20
+
+    def _call(self, tree):
+        return '%s(%s)' % (tree[1], ', '.join(
+            [self.code(arg)[0] for arg in tree[2]])), 20
+
+    def _list(self, tree):
+        return '[%s]' % ', '.join([self.code(item)[0]
+                                   for item in tree[1]]), 20
+
+    def _unary(self, tree):
+        operand, precedence = self.code(tree[2])
+        if tree[1] == 'not':
+            if precedence < _precedence['not']:
+                operand = '(%s)' % operand
+            return 'not ' + operand, _precedence['not']
+        if precedence <= _precedence['unary']:
+            operand = '(%s)' % operand
+        return tree[1] + operand, _precedence['unary']
+
+    def _compare(self, tree):
+        precedence = _precedence['compare']
+        operands = []
+        for subtree in tree[2:]:
+            code, operand_precedence = self.code(subtree)
+            if operand_precedence <= precedence:
+                code = '(%s)' % code
+            operands.append(code)
+        return '%s %s %s' % (operands[0], tree[1], operands[1]), precedence
+
+    def _logic(self, tree):
+        precedence = _precedence[tree[1]]
+        operands = []
+        for subtree in tree[2]:
+            code, operand_precedence = self.code(subtree)
+            if operand_precedence <= precedence:
+                code = '(%s)' % code
+            operands.append(code)
+        return (' %s ' % tree[1]).join(operands), precedence
+
+    def _if(self, tree):
+        precedence = _precedence['if']
+        condition, value, alternative = [self.code(subtree)
+                                         for subtree in tree[1:]]
+        code = []
+        for operand, operand_precedence in condition, value:
+            code.append('(%s)' % operand if operand_precedence <= precedence
+                        else operand)
+        return '%s if %s else %s' % (code[1], code[0], alternative[0]), \
+               precedence
+
+    def _binop(self, tree):
+        op = tree[1]
+        precedence = _precedence[op]
+        left, left_precedence = self.code(tree[2])
+        right, right_precedence = self.code(tree[3])
+        if op == '**':  # right associative
+            if left_precedence <= precedence:
+                left = '(%s)' % left
+            if right_precedence < precedence:
+                right = '(%s)' % right
+        else:
+            if left_precedence < precedence:
+                left = '(%s)' % left
+            if right_precedence <= precedence:
+                right = '(%s)' % right
+        return left + op + right, precedence
+
+_python_code = _PythonPrinter()
+
+
+class _NumpyPrinter(_PythonPrinter):
+    """
+    Translate a tree to Python code for NumPy arrays: conditional
+    expressions become numpy.where (or numpy.select for a chain of
+    conditions, as from piecewise) and and/or/not become the logical
+    ufuncs (the names are defined by _numpy_namespace).
+    """
+
+    def _unary(self, tree):
+        if tree[1] == 'not':
+            return '_logical_not(%s)' % self.code(tree[2])[0], 20
+        return _PythonPrinter._unary(self, tree)
+
+    def _logic(self, tree):
+        function = '_logical_%s' % tree[1]
+        code = self.code(tree[2][0])[0]
+        for subtree in tree[2][1:]:
+            code = '%s(%s, %s)' % (function, code, self.code(subtree)[0])
+        return code, 20
+
+    def _if(self, tree):
+        conditions = []
+        values = []
+        while tree[0] == 'if' and tree not in self.names:
+            conditions.append(self.code(tree[1])[0])
+            values.append(self.code(tree[2])[0])
+            tree = tree[3]
+        if len(conditions) == 1:
+            return '_where(%s, %s, %s)' % (conditions[0], values[0],
+                                           self.code(tree)[0]), 20
+        return '_select([%s], [%s], %s)' % (
+            ', '.join(conditions), ', '.join(values), self.code(tree)[0]), 20
+
+_numpy_code = _NumpyPrinter()
+
+
+# ---------------------------------------------------------------------------
+# C code generation and compilation (StringFunction.compile)
+# ---------------------------------------------------------------------------
+
+# functions in C's math.h with the same meaning as in math/numpy:
+_c_functions = {'acos': 'acos', 'asin': 'asin', 'atan': 'atan',
+                'atan2': 'atan2', 'ceil': 'ceil', 'cos': 'cos',
+                'cosh': 'cosh', 'exp': 'exp', 'fabs': 'fabs',
+                'floor': 'floor', 'log': 'log', 'log10': 'log10',
+                'pow': 'pow', 'sin': 'sin', 'sinh': 'sinh', 'sqrt': 'sqrt',
+                'tan': 'tan', 'tanh': 'tanh', 'abs': 'fabs'}
+
+
+def _standard_function(namespace, name):
+    """
+    Return True if name in namespace is the builtin, math or NumPy
+    function of that name (and can be translated to C).
+    """
+    function = namespace.get(name, getattr(builtins, name, None))
+    return function is getattr(builtins, name, None) or \
+           getattr(function, '__module__', None) in ('math', 'numpy')
+
+
+class _CPrinter(_PythonPrinter):
+    """
+    Translate a tree to a C expression (in double precision).
+    ** and pow become pow, // becomes floor of the quotient, % is
+    the Python modulo (sign of the divisor, function sf_mod in
+    _c_preamble), and names of numbers in namespace (e.g. pi)
+    become number literals. The independent variables, parameters
+    and temporaries must be in the names dict. Other names and
+    functions are printed as they are (e.g. functions the user
+    writes in C), unless strict is true (code to be compiled),
+    where they raise ValueError.
+    """
+
+    def __init__(self, names=None, namespace=None, strict=False):
+        _PythonPrinter.__init__(self, names)
+        self.namespace = {} if namespace is None else namespace
+        self.strict = strict
+
+    def _num(self, tree):
+        code = repr(float(tree[1]))
+        code = {'inf': 'HUGE_VAL', '-inf': '-HUGE_VAL', 'nan': 'NAN'}.get(
+            code, code)
+        return ('(%s)' % code if tree[1] < 0 else code), 20
+
+    def _name(self, tree):
+        value = self.namespace.get(tree[1], getattr(math, tree[1], None))
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return self._num(('num', value))
+        if self.strict:
+            raise ValueError('cannot translate the name %s to C' % tree[1])
+        return tree[1], 20
+
+    def _call(self, tree):
+        name = tree[1]
+        if name not in _c_functions or \
+           not _standard_function(self.namespace, name):
+            if self.strict:
+                raise ValueError('cannot translate the function %s to C'
+                                 % name)
+            return _PythonPrinter._call(self, tree)
+        return '%s(%s)' % (_c_functions[name], ', '.join(
+            [self.code(arg)[0] for arg in tree[2]])), 20
+
+    def _list(self, tree):
+        raise ValueError('vector fields need the kernel=True code '
+                         '(output arrays)')
+
+    _logic_operators = {'and': '&&', 'or': '||', 'not': '!'}
+
+    def _unary(self, tree):
+        # parenthesize to avoid -- and ++ in C
+        operand, precedence = self.code(tree[2])
+        if precedence <= _precedence['unary']:
+            operand = '(%s)' % operand
+        return '(%s%s)' % (self._logic_operators.get(tree[1], tree[1]),
+                           operand), 20
+
+    def _compare(self, tree):
+        return '(%s %s %s)' % (self.code(tree[2])[0], tree[1],
+                               self.code(tree[3])[0]), 20
+
+    def _logic(self, tree):
+        return '(%s)' % (' %s ' % self._logic_operators[tree[1]]).join(
+            [self.code(subtree)[0] for subtree in tree[2]]), 20
+
+    def _if(self, tree):
+        return '(%s ? %s : %s)' % tuple([self.code(subtree)[0]
+                                         for subtree in tree[1:]]), 20
+
+    def _binop(self, tree):
+        op = tree[1]
+        if op in ('**', '//', '%'):
+            left = self.code(tree[2])[0]
+            right = self.code(tree[3])[0]
+            template = {'**': 'pow(%s, %s)', '//': 'floor(%s/%s)',
+                        '%': 'sf_mod(%s, %s)'}[op]
+            if op == '//':
+                left, right = ['(%s)' % code if precedence < 20 else code
+                               for code, precedence in (self.code(tree[2]),
+                                                        self.code(tree[3]))]
+            return template % (left, right), 20
+        return _PythonPrinter._binop(self, tree)
+
+
+class _FortranPrinter(_CPrinter):
+    """
+    Translate a tree to a Fortran expression (in double precision).
+    pow becomes **, // becomes the floor of the quotient, % becomes
+    modulo (same sign convention as Python).
+    """
+
+    def _num(self, tree):
+        if type(tree[1]) is int and abs(tree[1]) < 2**31:
+            code = '%dd0' % tree[1]
+        else:
+            code = repr(float(tree[1]))
+            if not math.isfinite(tree[1]):
+                raise ValueError('cannot translate %s to Fortran' % code)
+            code = code.replace('e', 'd') if 'e' in code else code + 'd0'
+        return ('(%s)' % code if tree[1] < 0 else code), 20
+
+    def _call(self, tree):
+        name = tree[1]
+        if name == 'pow' and len(tree[2]) == 2 and \
+           _standard_function(self.namespace, name):
+            return self._binop(('binop', '**') + tree[2])
+        if name == 'fabs' or name == 'abs':
+            tree = ('call', 'abs', tree[2])
+            name = 'fabs'
+        if name not in _c_functions or \
+           not _standard_function(self.namespace, name):
+            if self.strict:
+                raise ValueError('cannot translate the function %s to '
+                                 'Fortran' % name)
+            return _PythonPrinter._call(self, tree)
+        return '%s(%s)' % (tree[1], ', '.join(
+            [self.code(arg)[0] for arg in tree[2]])), 20
+
+    _logic_operators = {'and': '.and.', 'or': '.or.', 'not': '.not. '}
+    _compare_operators = {'<': '.lt.', '<=': '.le.', '>': '.gt.',
+                          '>=': '.ge.', '==': '.eq.', '!=': '.ne.'}
+
+    def _compare(self, tree):
+        return '(%s %s %s)' % (self.code(tree[2])[0],
+                               self._compare_operators[tree[1]],
+                               self.code(tree[3])[0]), 20
+
+    def _if(self, tree):
+        return 'merge(%s, %s, %s)' % tuple([self.code(subtree)[0]
+                                            for subtree in tree[2:] +
+                                            tree[1:2]]), 20
+
+    def _binop(self, tree):
+        op = tree[1]
+        if op == '**':
+            exponent = tree[3]
+            if exponent[0] == 'num' and type(exponent[1]) is int and \
+               0 <= exponent[1] < 2**31:
+                # integer exponents are computed by multiplications
+                left, precedence = self.code(tree[2])
+                if precedence <= _precedence['**']:
+                    left = '(%s)' % left
+                return '%s**%d' % (left, exponent[1]), _precedence['**']
+            return _PythonPrinter._binop(self, tree)
+        if op == '//':
+            return 'dble(floor(%s/%s))' % tuple(
+                ['(%s)' % code if precedence < 20 else code
+                 for code, precedence in (self.code(tree[2]),
+                                          self.code(tree[3]))]), 20
+        if op == '%':
+            return 'modulo(%s, %s)' % (self.code(tree[2])[0],
+                                       self.code(tree[3])[0]), 20
+        return _PythonPrinter._binop(self, tree)
+
+
+def _f77_statement(statement, indent=''):
+    """
+    Return a Fortran 77 (fixed form) statement, starting in column 7
+    and continued on more lines if longer than 72 columns.
+    """
+    lines = []
+    statement = indent + statement
+    while len(statement) > 66:
+        # split after an operator or a comma
+        for i in range(66, 20, -1):
+            if statement[i-1] in '+-*/,(' and statement[i-2:i] != '**':
+                break
+        else:
+            i = 66
+        lines.append(statement[:i])
+        statement = indent + statement[i:]
+    lines.append(statement)
+    return '      ' + '\n     &'.join(lines) + '\n'
+
+
+def _wrap(text, width, indent):
+    """Split text (a comma-separated list) into lines of at most width."""
+    lines = ['']
+    for item in text.split(', '):
+        if lines[-1] and len(lines[-1]) + len(item) + 2 > width:
+            lines[-1] += ','
+            lines.append(item)
+        else:
+            lines[-1] += (', ' if lines[-1] else '') + item
+    return ('\n' + indent).join(lines)
+
+
+_c_preamble = """\
+#include <math.h>
+
+/* Python's modulo: the result has the sign of the divisor */
+static double sf_mod(double a, double b)
+{
+  double r = fmod(a, b);
+  return (r != 0 && ((r < 0) != (b < 0))) ? r + b : r;
+}
+"""
+
+
+def _c_kernel_source(tree, hoisted, variables, parameters, namespace,
+                     function_name='sf_kernel'):
+    """
+    Return the C source of a function evaluating tree (as made by
+    StringFunction._optimized_tree) for n points:
+
+    void sf_kernel(long n, const double *const *inputs,
+                   const long *strides, const double *prm, double *out)
+
+    inputs[j][i*strides[j]] is variable j at point i (stride 0 for
+    a scalar), prm holds the parameter values, and component k of
+    a vector field at point i is stored in out[k*n + i]. For a
+    scalar formula, the function double sf_kernel_point(x, ..., prm)
+    evaluates one point.
+
+    >>> print(_c_kernel_source(_parse('A*x**2 % 3'), [], ('x',), ('A',), {},
+    ...                        'f').split('\\n', 9)[-1].split('\\n\\n')[0])
+    void f(long n, const double *const *inputs, const long *strides,
+           const double *prm, double *out)
+    {
+      const double A = prm[0];
+      long i;
+      for (i = 0; i < n; i++) {
+        const double x = inputs[0][i*strides[0]];
+        out[i] = sf_mod(A*pow(x, 2.0), 3.0);
+      }
+    }
+    """
+    # fixed names, renamed if they clash with names in the formula:
+    local = _local_names(('n', 'i', 'inputs', 'strides', 'prm', 'out'),
+                         set(variables) | set(parameters) | _names(tree))
+    printer = _CPrinter(namespace=namespace, strict=True)
+    for name in tuple(variables) + tuple(parameters):
+        printer.names[('name', name)] = name
+    body = ['  const double %s = %s[%d];' % (name, local['prm'], i)
+            for i, name in enumerate(parameters)]
+    # parameter-only subexpressions are computed once, before the loop:
+    for name, subtree in hoisted:
+        body.append('  const double %s = %s;' % (name, printer(subtree)))
+        printer.names[('name', name)] = name
+    # (the names of the loop's temporaries are not valid in sf_kernel_point)
+    names = dict(printer.names)
+    body += ['  long %(i)s;' % local,
+             '  for (%(i)s = 0; %(i)s < %(n)s; %(i)s++) {' % local]
+    body += ['    const double %s = %s[%d][%s*%s[%d]];' % (
+                 name, local['inputs'], j, local['i'], local['strides'], j)
+             for j, name in enumerate(variables)]
+    components = _list_shape(tree)[1]
+    for name, subtree in _common_subtrees(tree):
+        body.append('    const double %s = %s;' % (name, printer(subtree)))
+        printer.names[subtree] = name
+    for k, component in enumerate(components):
+        body.append('    %s[%s%s] = %s;' % (
+            local['out'], '%d*%s + ' % (k, local['n']) if k else '',
+            local['i'], printer(component)))
+    body += ['  }', '}']
+    source = _c_preamble + """
+void %s(long %s, const double *const *%s, const long *%s,
+       const double *%s, double *%s)
+{
+""" % ((function_name,) + tuple([local[name] for name in
+                                 ('n', 'inputs', 'strides', 'prm', 'out')])) \
+        + '\n'.join(body) + '\n'
+    if tree[0] != 'list':
+        # function for one point (called directly for scalar arguments):
+        body = body[:len(parameters) + len(hoisted)]
+        printer.names = names
+        for name, subtree in _common_subtrees(tree):
+            body.append('  const double %s = %s;' % (name, printer(subtree)))
+            printer.names[subtree] = name
+        body += ['  return %s;' % printer(tree), '}']
+        source += """
+double %s_point(%s)
+{
+""" % (function_name, ', '.join(['double %s' % name for name in variables] +
+                                ['const double *%s' % local['prm']])) + \
+            '\n'.join(body) + '\n'
+    return source
+
+
+def _local_names(names, used, ignore_case=False):
+    """
+    Return a dict that maps the names of the fixed arguments and
+    local variables of generated code to themselves, or, if they
+    clash with a name in used (e.g. a parameter n), to the name with
+    the prefix sf_ (for Fortran, with ignore_case true).
+
+    >>> local = _local_names(('n', 'i', 'out'), {'x', 'n'})
+    >>> local['n'], local['i'], local['out']
+    ('sf_n', 'i', 'out')
+    """
+    if ignore_case:
+        used = set([name.lower() for name in used])
+    local = {}
+    for name in names:
+        new = name
+        while (new.lower() if ignore_case else new) in used:
+            new = 'sf_' + new
+        local[name] = new
+    return local
+
+
+# directory of the shared libraries compiled by StringFunction.compile:
+cache_dir = os.environ.get('SCITOOLS_CACHE_DIR', os.path.join(
+    os.path.expanduser('~'), '.cache', 'scitools', 'StringFunction'))
+
+# C compiler command (the source file and -o library are appended):
+c_compiler = os.environ.get('CC', 'cc').split() + \
+             ['-O3', '-fPIC', '-shared', '-fno-math-errno']
+
+# shared libraries loaded in this process (key: hash of the source):
+_c_libraries = {}
+_c_libraries_lock = threading.Lock()
+
+
+def _c_library(source):
+    """
+    Return the ctypes library compiled from the C source. The
+    library is stored in cache_dir under a name made from a hash of
+    the source and the compiler command, so it is compiled only once
+    (also across processes).
+    """
+    import ctypes, hashlib, subprocess, tempfile
+    key = hashlib.sha256(
+        (' '.join(c_compiler) + '\n' + source).encode()).hexdigest()[:32]
+    with _c_libraries_lock:
+        if key in _c_libraries:
+            return _c_libraries[key]
+        path = os.path.join(cache_dir, 'sf_%s.so' % key)
+        if not os.path.exists(path):
+            os.makedirs(cache_dir, exist_ok=True)
+            # compile in a temporary directory and move the library in
+            # place (atomically, in case other processes compile it too):
+            tmpdir = tempfile.mkdtemp(dir=cache_dir)
+            try:
+                src = os.path.join(tmpdir, 'sf_%s.c' % key)
+                with open(src, 'w') as f:
+                    f.write(source)
+                library = os.path.join(tmpdir, 'sf_%s.so' % key)
+                command = c_compiler + [src, '-o', library, '-lm']
+                try:
+                    result = subprocess.run(command, stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT,
+                                            universal_newlines=True)
+                except OSError as e:
+                    raise RuntimeError('could not run the C compiler %s: %s'
+                                       % (command[0], e))
+                if result.returncode != 0:
+                    raise RuntimeError('C compilation failed:\n%s\n%s' %
+                                       (' '.join(command), result.stdout))
+                os.replace(library, path)
+            finally:
+                import shutil
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        _c_libraries[key] = ctypes.CDLL(path)
+        return _c_libraries[key]
+
+
+class CompiledFunction(object):
+    """
+    A StringFunction formula compiled to machine code (made by
+    StringFunction.compile). Calls take the independent variables as
+    numbers or arrays (broadcast against each other) and return
+    float64 arrays (floats for scalar arguments); parameter values
+    are taken from the StringFunction at call time and can be
+    overridden by keyword arguments as for the StringFunction.
+    The C source is available as the source attribute.
+    """
+
+    def __init__(self, function, source, function_name='sf_kernel'):
+        import ctypes
+        self.function = function
+        self.source = source
+        self.component_shape = _list_shape(function._tree())[0]
+        library = _c_library(source)
+        self._kernel = getattr(library, function_name)
+        self._kernel.restype = None
+        self._kernel.argtypes = [ctypes.c_long, ctypes.c_void_p,
+                                 ctypes.c_void_p, ctypes.c_void_p,
+                                 ctypes.c_void_p]
+        self._point = None
+        if not self.component_shape:
+            self._point = getattr(library, function_name + '_point')
+            self._point.restype = ctypes.c_double
+            self._point.argtypes = [ctypes.c_double]*len(function._var) + \
+                                   [ctypes.c_void_p]
+        # parameter values and the ctypes array used by self._point:
+        self._point_values = None
+        self._point_prm = None
+
+    def __call__(self, *args, **kwargs):
+        if self._point is not None and not kwargs and \
+           len(args) == len(self.function._var):
+            for arg in args:
+                if type(arg) not in _scalar_types:
+                    break
+            else:
+                return self._point(*(args + (self._point_parameters(),)))
+        return self._array_call(args, kwargs)
+
+    def _point_parameters(self):
+        """Return the parameter values as a ctypes array (cached)."""
+        import ctypes
+        values = self.function._parameter_values()
+        if values != self._point_values:
+            self._point_prm = (ctypes.c_double*max(1, len(values)))(*values)
+            self._point_values = values
+        return self._point_prm
+
+    def _array_call(self, args, kwargs):
+        import ctypes, numpy
+        out = kwargs.pop('out', None)
+        function = self.function
+        if len(args) != len(function._var):
+            raise TypeError('%d independent variables, %d arguments' %
+                            (len(function._var), len(args)))
+        parameters = dict(zip(function._prms, function._parameter_values()))
+        for name in kwargs:
+            if name not in parameters:
+                raise TypeError('%s is not a parameter' % name)
+        parameters.update(kwargs)
+        prm = numpy.array([parameters[name] for name in function._prms] or
+                          [0.0], dtype=float)
+        arrays = [numpy.asarray(a, dtype=float) for a in args]
+        shape = numpy.broadcast_shapes(*[a.shape for a in arrays]) \
+                if arrays else ()
+        n = int(numpy.prod(shape))
+        inputs, strides = [], []
+        for a in arrays:
+            if a.size == 1:
+                a, stride = a.reshape(1), 0
+            else:
+                a, stride = numpy.ascontiguousarray(
+                    numpy.broadcast_to(a, shape)), 1
+            inputs.append(a)
+            strides.append(stride)
+        out_shape = self.component_shape + shape
+        if out is None:
+            out = numpy.empty(out_shape)
+        elif out.shape != out_shape or out.dtype != numpy.float64 or \
+             not out.flags.c_contiguous:
+            raise ValueError('out must be a C contiguous float64 array of '
+                             'shape %s' % (out_shape,))
+        pointers = (ctypes.c_void_p*max(1, len(inputs)))(
+            *[a.ctypes.data for a in inputs])
+        strides = numpy.array(strides or [0], dtype=numpy.int64 if
+                              ctypes.sizeof(ctypes.c_long) == 8 else
+                              numpy.int32)
+        self._kernel(n, ctypes.addressof(pointers), strides.ctypes.data,
+                     prm.ctypes.data, out.ctypes.data)
+        if not shape and all([numpy.ndim(a) == 0 for a in args]):
+            return out.tolist() if self.component_shape else float(out)
+        return out
+
+    def __repr__(self):
+        return 'CompiledFunction(%r)' % self.function
+
+
+class TabulatedFunction(object):
+    """
+    A StringFunction formula replaced by interpolation in a table of
+    its values on a uniform grid (made by StringFunction.tabulate).
+    Calls take the independent variables as numbers or arrays
+    (broadcast against each other) inside the domain and return
+    float64 arrays (floats for scalar arguments). The parameter values
+    are those at the time of tabulation.
+
+    Attributes: domain ((lower, upper) for each independent variable),
+    n (number of grid points for each variable), kind ('linear' or
+    'cubic'), values (the table) and error (estimated maximum absolute
+    error: the largest difference from the formula at the cell
+    midpoints, computed at the first access).
+
+    Cubic interpolation is piecewise cubic Hermite interpolation (in
+    each variable), with the derivatives tabulated from the symbolic
+    derivatives of the formula (see diff), or estimated by
+    second-order differences in the table if the formula cannot be
+    differentiated (e.g. a function in a module).
+    """
+
+    def __init__(self, function, domain, n, kind, parameters):
+        import numpy
+        if kind not in ('linear', 'cubic'):
+            raise ValueError('kind must be "linear" or "cubic", not %r'
+                             % kind)
+        if min(n) < (3 if kind == 'cubic' else 2):
+            raise ValueError('too few grid points: %s' % (n,))
+        self.function = function
+        self.domain = domain
+        self.n = n
+        self.kind = kind
+        self._parameters = parameters
+        self._lower = [lower for lower, upper in domain]
+        self._upper = [upper for lower, upper in domain]
+        self._step = [(upper - lower)/(m - 1)
+                      for (lower, upper), m in zip(domain, n)]
+        grids = [numpy.linspace(lower, upper, m)
+                 for (lower, upper), m in zip(domain, n)]
+        self.values = self._formula_values(grids)
+        # tables of values and derivatives (cubic) for each subset of
+        # the axes (the variables the table is differentiated with
+        # respect to):
+        tables = {(): self.values}
+        if kind == 'cubic':
+            derivatives = {(): function}
+            for axis, step in enumerate(self._step):
+                for axes, table in list(tables.items()):
+                    estimate = numpy.gradient(table, step, axis=axis,
+                                              edge_order=2)
+                    try:
+                        derivative = derivatives[axes].diff(
+                            function._var[axis])
+                        derivatives[axes + (axis,)] = derivative
+                        with numpy.errstate(divide='ignore', over='ignore',
+                                            invalid='ignore'):
+                            table = self._formula_values(grids, derivative)
+                        # (the symbolic derivative can be e.g. 0*inf
+                        # where the derivative is finite)
+                        table = numpy.where(numpy.isfinite(table), table,
+                                            estimate)
+                    except (KeyError, ValueError, ArithmeticError):
+                        table = estimate
+                    tables[axes + (axis,)] = table
+        self._coefficients = self._cell_polynomials(tables)
+        cells = [m - 1 for m in n]
+        self._strides = [int(numpy.prod(cells[axis+1:]))
+                         for axis in range(len(n))]
+        self._error = None
+
+    def _cell_polynomials(self, tables):
+        """
+        Return the coefficients of the interpolating polynomial in
+        each cell (from the tables of values and derivatives made in
+        the constructor), in the position t (0 <= t <= 1) along each axis:
+        c[p0][p1]... is the flat array (over the cells) of the
+        coefficient of t0**p0*t1**p1*...
+        """
+        import itertools, numpy
+        if self.kind == 'linear':
+            # the values at the cell ends -> coefficients of 1, t:
+            ends = [(0, False), (1, False)]
+            matrix = numpy.array([[1, 0], [-1, 1]])
+        else:
+            # values and scaled derivatives at the ends (Hermite)
+            # -> coefficients of 1, t, t**2, t**3:
+            ends = [(0, False), (1, False), (0, True), (1, True)]
+            matrix = numpy.array([[1, 0, 0, 0], [0, 0, 1, 0],
+                                  [-3, 3, -2, -1], [2, -2, 1, 1]])
+        dimension = len(self.n)
+        cells = tuple([m - 1 for m in self.n])
+        data = numpy.empty((len(ends),)*dimension + cells)
+        for quantities in itertools.product(range(len(ends)),
+                                            repeat=dimension):
+            axes = tuple([axis for axis in range(dimension)
+                          if ends[quantities[axis]][1]])
+            table = tables[axes]
+            for axis in axes:
+                table = table*self._step[axis]
+            data[quantities] = table[tuple(
+                [slice(ends[q][0], ends[q][0] + m)
+                 for q, m in zip(quantities, cells)])]
+        for axis in range(dimension):
+            data = numpy.moveaxis(numpy.tensordot(matrix, data,
+                                                  axes=(1, axis)), 0, axis)
+        return data.reshape(data.shape[:dimension] + (-1,))
+
+    def _formula_values(self, grids, function=None):
+        """
+        Return the values of the formula (or of function) at the
+        points of the grids.
+        """
+        import numpy
+        if function is None:
+            function = self.function
+        points = [x.ravel() for x in numpy.meshgrid(*grids, indexing='ij')]
+        shape = tuple([len(x) for x in grids])
+        try:
+            values = numpy.asarray(function.evaluate(
+                *points, **self._parameters), dtype=float)
+        except (TypeError, ValueError):
+            # e.g. functions in modules that work for numbers only
+            values = numpy.array([function(*point, **self._parameters)
+                                  for point in zip(*[x.tolist()
+                                                     for x in points])],
+                                 dtype=float)
+        if values.shape != points[0].shape:
+            raise ValueError('only formulas with scalar values can be '
+                             'tabulated')
+        return values.reshape(shape)
+
+    @property
+    def error(self):
+        if self._error is None:
+            import numpy
+            midpoints = [numpy.linspace(lower + step/2, upper - step/2, m - 1)
+                         for lower, upper, step, m in zip(
+                             self._lower, self._upper, self._step, self.n)]
+            exact = self._formula_values(midpoints)
+            approximation = self(*numpy.meshgrid(*midpoints, indexing='ij'))
+            self._error = float(numpy.max(numpy.abs(exact - approximation)))
+        return self._error
+
+    def __call__(self, *args):
+        import numpy
+        if len(args) != len(self.n):
+            raise TypeError('%d independent variables, %d arguments' %
+                            (len(self.n), len(args)))
+        arrays = numpy.broadcast_arrays(*[numpy.asarray(a, dtype=float)
+                                          for a in args])
+        for x, lower, upper in zip(arrays, self._lower, self._upper):
+            if x.size and (numpy.min(x) < lower or numpy.max(x) > upper):
+                raise ValueError('arguments outside the domain [%g, %g]'
+                                 % (lower, upper))
+        if not arrays[0].ndim:
+            return float(self._interpolate(arrays))
+        # interpolate block by block, such that the temporary arrays
+        # stay in the CPU cache (cf. StringFunction.evaluate):
+        shape = arrays[0].shape
+        arrays = [x.ravel() for x in arrays]
+        out = numpy.empty(arrays[0].size)
+        block_size = max(256, cache_block_bytes // (8*(len(arrays) + 4)))
+        for start in range(0, out.size, block_size):
+            block = slice(start, start + block_size)
+            out[block] = self._interpolate([x[block] for x in arrays])
+        return out.reshape(shape)
+
+    def _interpolate(self, arrays):
+        """Return the interpolated values at the points in arrays."""
+        import numpy
+        # flat index of the cell and position in the cell
+        # (0 <= t <= 1) along each axis:
+        cell = 0
+        positions = []
+        for x, lower, step, m, stride in zip(arrays, self._lower, self._step,
+                                             self.n, self._strides):
+            t = x - lower
+            t *= 1.0/step
+            i = numpy.minimum(t.astype(numpy.intp), m - 2)
+            t -= i
+            cell = cell + (i*stride if stride != 1 else i)
+            positions.append(t)
+        return self._horner(self._coefficients, cell, positions)
+
+    def _horner(self, coefficients, cell, positions):
+        """Evaluate the cell polynomials by Horner's rule."""
+        if not positions:
+            return coefficients.take(cell)
+        t = positions[0]
+        result = self._horner(coefficients[-1], cell, positions[1:])
+        for power in range(len(coefficients) - 2, -1, -1):
+            result *= t
+            result += self._horner(coefficients[power], cell, positions[1:])
+        return result
+
+    def __repr__(self):
+        return 'TabulatedFunction(%r, domain=%s, n=%s, kind=%r)' % (
+            self.function, self.domain, self.n, self.kind)
+
+
+# size (in bytes) of the arrays used in one block of
+# StringFunction.evaluate (about the size of the L2 cache):
+cache_block_bytes = 2**19
+
+
+class SweepResult(object):
+    """
+    Result of StringFunction.sweep: an array of values with a name
+    (in dims) for each axis, and coordinates (in the dict coords)
+    for the axes of the swept parameters (and of a 1D independent
+    variable). The object can be used as a NumPy array.
+    """
+
+    def __init__(self, values, dims, coords):
+        self.values = values
+        self.dims = tuple(dims)
+        self.coords = coords
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def __array__(self, dtype=None, copy=None):
+        import numpy
+        return numpy.asarray(self.values, dtype=dtype)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def sel(self, **indices):
+        """
+        Return the values for given indices along named axes,
+        e.g. r.sel(A=0, w=2) is r.values[0, 2] for dims ('A', 'w', 'x').
+        """
+        index = tuple([indices.pop(name, slice(None)) for name in self.dims])
+        if indices:
+            raise ValueError('no axes named %s' % ', '.join(indices))
+        return self.values[index]
+
+    def __repr__(self):
+        return 'SweepResult(dims=%s, shape=%s)' % (self.dims, self.shape)
+
+
+class Workspace(object):
+    """
+    Scratch arrays for StringFunction.evaluate (and calls with an out
+    argument). The arrays are allocated in the first call and reused
+    in later calls, so repeated evaluations (e.g. in time stepping)
+    do not allocate memory:
+
+    >>> from numpy import linspace, empty_like
+    >>> f = StringFunction('exp(-b*t)*sin(x)',
+    ...                    independent_variables=('x', 't'), b=0.5)
+    >>> x = linspace(0, pi/2, 3)
+    >>> u = empty_like(x)
+    >>> work = Workspace()
+    >>> for t in 0, 0.5, 1:
+    ...     u = f(x, t, out=u, workspace=work)
+    >>> u
+    array([0.        , 0.42888194, 0.60653066])
+
+    A workspace must not be used in several simultaneous calls
+    (e.g. from different threads), but it can be shared by several
+    StringFunction objects.
+    """
+
+    def __init__(self):
+        self._scratch = {}  # task number -> list of scratch arrays
+
+    def scratch(self, task, n, size):
+        """
+        Return n scratch arrays of (at least) the given size for the
+        given task (thread) number.
+        """
+        import numpy
+        arrays = self._scratch.get(task, [])
+        if len(arrays) < n or (arrays and len(arrays[0]) < size):
+            size = max([size] + [len(a) for a in arrays])
+            arrays = [numpy.empty(size) for i in range(max(n, len(arrays)))]
+            self._scratch[task] = arrays
+        return arrays[:n]
+
+
+# default number of threads used by StringFunction.evaluate:
+evaluation_threads = 1
+
+_executor = None  # (number of threads, ThreadPoolExecutor)
+_executor_lock = threading.Lock()
+
+
+def _thread_executor(threads):
+    """Return a thread pool with (at least) the given number of threads."""
+    global _executor
+    with _executor_lock:
+        if _executor is None or _executor[0] < threads:
+            from concurrent.futures import ThreadPoolExecutor
+            # a smaller pool is not shut down, since other threads may
+            # still submit to it (its threads exit when it is no longer
+            # referenced)
+            _executor = (threads, ThreadPoolExecutor(
+                threads, thread_name_prefix='StringFunction'))
+        return _executor[1]
+
+
+# size (in bytes) of the chunks read and written in
+# StringFunction.evaluate_out_of_core:
+out_of_core_bytes = 2**26
+
+
+class _ArrayFile(object):
+    """
+    A float/int array in a .npy file (or the file of a numpy.memmap
+    array, C order), read and written in chunks of rows (along the
+    first dimension, or the second for the leading component
+    dimensions of a vector field) with plain file I/O.
+    """
+
+    def __init__(self, array):
+        import numpy
+        if isinstance(array, numpy.memmap):
+            import mmap
+            if array.filename is None or not array.flags.c_contiguous or \
+               not isinstance(array.base, mmap.mmap):
+                raise ValueError('a numpy.memmap argument must be a C '
+                                 'contiguous array mapping a file '
+                                 '(not a part of such an array)')
+            self.path = array.filename
+            self.offset = array.offset
+            self.shape = array.shape
+            self.dtype = array.dtype
+        else:
+            self.path = os.fspath(array)
+            with open(self.path, 'rb') as f:
+                version = numpy.lib.format.read_magic(f)
+                header = getattr(numpy.lib.format, 'read_array_header_%d_%d'
+                                 % version)(f)
+                self.offset = f.tell()
+            self.shape, fortran_order, self.dtype = header
+            if fortran_order and len(self.shape) > 1:
+                raise ValueError('%s: Fortran order is not supported'
+                                 % self.path)
+
+    @staticmethod
+    def create(path, shape):
+        """Create a float64 .npy file of the given shape."""
+        import numpy
+        numpy.lib.format.open_memmap(path, mode='w+', dtype=numpy.float64,
+                                     shape=shape)
+
+    def _rows(self, shape):
+        # number of elements in a row of an array of the given shape
+        import numpy
+        return int(numpy.prod(shape[1:]))
+
+    def read(self, start, stop):
+        """Return rows start:stop (of the first dimension)."""
+        import numpy
+        size = self._rows(self.shape)
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset + start*size*self.dtype.itemsize)
+            data = numpy.fromfile(f, self.dtype, (stop - start)*size)
+        return data.reshape((stop - start,) + self.shape[1:])
+
+    def write(self, start, stop, values, component_ndim=0):
+        """
+        Write values to rows start:stop (of the first dimension after
+        the component_ndim leading component dimensions) and flush
+        the data to the disk.
+        """
+        import numpy
+        point_shape = self.shape[component_ndim:]
+        size = self._rows(point_shape)  # elements in a row
+        n = int(numpy.prod(point_shape))  # elements in a component
+        values = numpy.asarray(values, dtype=self.dtype)
+        with open(self.path, 'r+b') as f:
+            for k, component in enumerate(
+                    values.reshape((-1, (stop - start)*size))):
+                f.seek(self.offset + (k*n + start*size)*self.dtype.itemsize)
+                component.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _array_digest(a):
+    """
+    Return a string identifying the dtype, shape and data of the
+    array a (a hash of the data for large arrays).
+    """
+    import hashlib, numpy
+    if a.size < 16:
+        return repr(a)
+    data = hashlib.sha256(memoryview(numpy.ascontiguousarray(a)).cast('B'))
+    return '%s%s:%s' % (a.dtype.str, list(a.shape), data.hexdigest())
+
+
+def _write_json(path, data):
+    """Write data to a JSON file (atomically, via a temporary file)."""
+    import json
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+_process_executors = {}
+_process_executors_lock = threading.Lock()
+
+
+def _process_executor(processes):
+    """Return a process pool with the given number of processes."""
+    with _process_executors_lock:
+        if processes not in _process_executors:
+            from concurrent.futures import ProcessPoolExecutor
+            _process_executors[processes] = ProcessPoolExecutor(processes)
+        return _process_executors[processes]
+
+
+def _evaluate_shared(function, inputs, output, n, start, stop, kwargs):
+    """
+    Worker of StringFunction.evaluate_parallel: evaluate function for
+    the points start:stop of the inputs (shared memory (name, dtype)
+    of n points, or values) and store the result in the shared memory
+    output (name, dtype, component shape).
+    """
+    import numpy
+    from multiprocessing import shared_memory
+    memory = []
+    try:
+        args = []
+        for value in inputs:
+            if isinstance(value, tuple):
+                shm = shared_memory.SharedMemory(name=value[0])
+                memory.append(shm)
+                value = numpy.ndarray((n,), value[1], shm.buf)[start:stop]
+            args.append(value)
+        name, dtype, component_shape = output
+        shm = shared_memory.SharedMemory(name=name)
+        memory.append(shm)
+        out = numpy.ndarray(component_shape + (n,), dtype, shm.buf)
+        out = out[..., start:stop]
+        try:
+            if out.flags.c_contiguous:
+                function.evaluate(*args, out=out, **kwargs)
+            else:
+                out[...] = function.evaluate(*args, **kwargs)
+        except (TypeError, ValueError):
+            # e.g. functions in modules that work for numbers only
+            if function._block_program():
+                raise
+            out[...] = function._point_values(args, kwargs)
+        del args, out, value  # release the buffers before closing
+    finally:
+        for shm in memory:
+            shm.close()
+
+
+def _split(n, parts, granularity):
+    """
+    Split range(n) in at most parts contiguous (start, stop) ranges,
+    where the boundaries are multiples of granularity.
+
+    >>> _split(10, 3, 2)
+    [(0, 2), (2, 6), (6, 10)]
+    >>> _split(10, 3, 8)
+    [(0, 8), (8, 10)]
+    """
+    chunks = max(1, -(-n // granularity))  # number of granularity chunks
+    parts = max(1, min(parts, chunks))
+    bounds = [min(n, (chunks*k // parts)*granularity)
+              for k in range(parts + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class _BlockProgram(object):
+    """
+    Evaluation of expression trees for arrays, block by block.
+
+    The trees (one per vector component) are translated to a list of
+    NumPy ufunc calls with out arguments. Subtrees that do not depend
+    on the inputs (independent variables) are computed once per call
+    by a lambda function; common subexpressions are computed once per
+    block. The intermediate results are stored in a few scratch arrays
+    of block length, which are reused as soon as a result is no longer
+    needed, so all arrays used in a block stay in the CPU cache.
+    """
+
+    def __init__(self, tree, inputs, parameters, namespace):
+        import numpy
+        # shape of (nested) vector fields and the component trees:
+        self.component_shape, roots = _list_shape(tree)
+        if 0 in self.component_shape:
+            raise ValueError('empty vector field')
+        self.inputs = tuple(inputs)
+        self.ncomponents = len(roots)
+
+        uniforms = []   # subtrees not depending on the inputs
+        memo = {}       # subtree -> operand (see _operand)
+        code = []       # [ufunc, [operand, ...]] (last operand is output)
+        self._ufuncs = {'+': numpy.add, '-': numpy.subtract,
+                        '*': numpy.multiply, '/': numpy.true_divide,
+                        '//': numpy.floor_divide, '%': numpy.remainder,
+                        '**': numpy.power}
+        self._ufuncs.update({'<': numpy.less, '<=': numpy.less_equal,
+                             '>': numpy.greater, '>=': numpy.greater_equal,
+                             '==': numpy.equal, '!=': numpy.not_equal,
+                             'and': numpy.logical_and,
+                             'or': numpy.logical_or})
+        self._unary_ufuncs = {'-': numpy.negative, '+': numpy.positive,
+                              'not': numpy.logical_not}
+        # both branches of a conditional are computed, so floating-point
+        # warnings from the branch that is not selected are suppressed:
+        self.conditional = _has_conditionals(tree)
+        self._namespace = namespace
+        self._varying = {}
+        for root in roots:
+            self._operand(root, memo, uniforms, code)
+
+        # let the results of the roots be written to the output
+        # arrays directly (or copied there):
+        outputs = {}  # virtual register -> output number
+        for i, root in enumerate(roots):
+            operand = memo[root]
+            if operand[0] == 'reg' and operand[1] not in outputs:
+                outputs[operand[1]] = i
+            else:
+                code.append([numpy.positive, [operand, ('out', i)]])
+        for instruction in code:
+            instruction[1] = [('out', outputs[op[1]])
+                              if op[0] == 'reg' and op[1] in outputs else op
+                              for op in instruction[1]]
+        # conditionals store the truth values of the condition in a
+        # bool view of an extra scratch array (the mask):
+        self.masked = False
+        for instruction in code:
+            if instruction[0] is _where_into:
+                instruction[1].insert(3, ('mask', 0))
+                self.masked = True
+        self.nregisters = self._allocate_registers(code)
+
+        # map operands to indices in the list of slots in a block:
+        # inputs, uniform values, scratch registers, outputs, mask
+        offsets = {'in': 0, 'uni': len(self.inputs),
+                   'reg': len(self.inputs) + len(uniforms)}
+        offsets['out'] = offsets['reg'] + self.nregisters
+        offsets['mask'] = offsets['out'] + self.ncomponents
+        self.nslots = offsets['mask'] + self.masked
+        self.mask_offset = offsets['mask']
+        self.uniform_offset = offsets['uni']
+        self.register_offset = offsets['reg']
+        self.output_offset = offsets['out']
+        self.code = [(ufunc, tuple([offsets[kind] + i
+                                    for kind, i in operands]))
+                     for ufunc, operands in code]
+
+        # lambda function computing the uniform values:
+        s = 'lambda %s: (%s,)' % (', '.join(parameters), ', '.join(
+            [_python_code(tree) for tree in uniforms]))
+        self.uniform_source = s
+        self.uniform_function = eval(s, namespace) if uniforms \
+                                else lambda **kwargs: ()
+
+    def _is_varying(self, tree):
+        """Return True if tree depends on the inputs."""
+        try:
+            return self._varying[tree]
+        except KeyError:
+            pass
+        if tree[0] == 'name':
+            varying = tree[1] in self.inputs
+        else:
+            varying = any([self._is_varying(subtree)
+                           for subtree in _subtrees(tree)])
+        self._varying[tree] = varying
+        return varying
+
+    def _operand(self, tree, memo, uniforms, code):
+        """
+        Return the operand holding the value of tree, after adding
+        the instructions computing it to code. An operand is
+        ('in', i) for input no. i, ('uni', i) for uniform value no. i,
+        ('reg', i) for virtual register i or ('out', i) for output i.
+        """
+        try:
+            return memo[tree]
+        except KeyError:
+            pass
+        kind = tree[0]
+        if not self._is_varying(tree):
+            operand = ('uni', len(uniforms))
+            uniforms.append(tree)
+        elif kind == 'name':
+            operand = ('in', self.inputs.index(tree[1]))
+        elif kind == 'logic' and len(tree[2]) > 2:
+            # a and b and c -> (a and b) and c
+            operand = self._operand(
+                (kind, tree[1], (tree[:2] + (tree[2][:-1],), tree[2][-1])),
+                memo, uniforms, code)
+        else:
+            if kind in ('binop', 'compare', 'logic'):
+                ufunc = self._ufuncs[tree[1]]
+            elif kind == 'if':
+                ufunc = _where_into
+            elif kind == 'unary':
+                ufunc = self._unary_ufuncs[tree[1]]
+            elif kind == 'call':
+                ufunc = self._ufunc(tree[1], len(tree[2]))
+            else:
+                raise ValueError('%s cannot be evaluated in blocks' % kind)
+            operands = [self._operand(subtree, memo, uniforms, code)
+                        for subtree in _subtrees(tree)]
+            operand = ('reg', len(code))
+            code.append([ufunc, operands + [operand]])
+        memo[tree] = operand
+        return operand
+
+    def _ufunc(self, name, nargs):
+        """Return the NumPy ufunc called name (in the namespace)."""
+        import numpy
+        if name in self._namespace:
+            ufunc = self._namespace[name]
+        elif name == 'abs':
+            ufunc = numpy.absolute
+        else:
+            ufunc = None
+        if not isinstance(ufunc, numpy.ufunc) or ufunc.nin != nargs \
+           or ufunc.nout != 1:
+            raise ValueError('%s is not a NumPy ufunc with %d arguments'
+                             % (name, nargs))
+        return ufunc
+
+    @staticmethod
+    def _allocate_registers(code):
+        """
+        Map the virtual registers in code (one per instruction) to
+        as few scratch registers as possible. Return the number of
+        scratch registers.
+        """
+        last_use = {}
+        for i, (ufunc, operands) in enumerate(code):
+            for op in operands[:-1]:
+                if op[0] == 'reg':
+                    last_use[op[1]] = i
+        free = []
+        nregisters = 0
+        register = {}  # virtual register -> scratch register
+        for i, instruction in enumerate(code):
+            operands = [('reg', register[op[1]]) if op[0] == 'reg' else op
+                        for op in instruction[1][:-1]]
+            # registers used for the last time can hold the result
+            # (ufuncs may write to their input arrays):
+            for op in instruction[1][:-1]:
+                if op[0] == 'reg' and last_use[op[1]] == i \
+                   and op[1] in register:
+                    free.append(register.pop(op[1]))
+            result = instruction[1][-1]
+            if result[0] == 'reg':
+                if free:
+                    register[result[1]] = free.pop()
+                else:
+                    register[result[1]] = nregisters
+                    nregisters += 1
+                result = ('reg', register[result[1]])
+            instruction[1] = operands + [result]
+        return nregisters
+
+    def evaluate(self, args, parameters, out=None, workspace=None,
+                 block_size=None, threads=None):
+        """
+        Evaluate the trees for the input values in args (arrays or
+        scalars) and the parameter values in the dict parameters,
+        using the given number of threads and the scratch arrays in
+        workspace (if not None).
+        Return the result array (out, if given), or NotImplemented
+        if the arguments or uniform values cannot be handled
+        (complex or non-numeric data, array-valued parameters).
+        """
+        import numpy
+        if len(args) != len(self.inputs):
+            raise TypeError('expected %d arguments (%s), got %d' %
+                            (len(self.inputs), ', '.join(self.inputs),
+                             len(args)))
+        slots = [None] * self.nslots
+        arrays = []  # (slot, array) for the array inputs
+        for i, arg in enumerate(args):
+            if not isinstance(arg, numpy.ndarray):
+                arg = numpy.asarray(arg)
+            if arg.dtype.kind not in 'biuf':
+                return NotImplemented
+            if arg.ndim == 0:
+                slots[i] = arg[()]
+            else:
+                arrays.append((i, arg))
+        if not arrays:
+            return NotImplemented
+        uniforms = self.uniform_function(**parameters)
+        for i, value in enumerate(uniforms):
+            if numpy.ndim(value) != 0 or \
+               numpy.asarray(value).dtype.kind not in 'biuf':
+                return NotImplemented
+            slots[self.uniform_offset + i] = value
+
+        shape = numpy.broadcast_shapes(*[a.shape for i, a in arrays])
+        out_shape = self.component_shape + shape
+        if out is None:
+            out = numpy.empty(out_shape)
+        elif out.shape != out_shape or out.dtype != numpy.float64:
+            raise ValueError('out must be a float64 array of shape %s, '
+                             'not %s array of shape %s' %
+                             (out_shape, out.dtype, out.shape))
+
+        if block_size is None:
+            block_size = max(256, cache_block_bytes //
+                             (8*(len(arrays) + self.nregisters +
+                                 self.ncomponents)))
+        if threads is None:
+            threads = evaluation_threads
+
+        if out.flags.c_contiguous and \
+           all([a.shape == shape and a.dtype == numpy.float64 and
+                a.flags.c_contiguous for i, a in arrays]):
+            # plain loop over blocks of the flattened arrays,
+            # threads take contiguous ranges of blocks:
+            n = int(numpy.prod(shape))
+            arrays = [(i, a.reshape(-1)) for i, a in arrays]
+            outputs = out.reshape(self.ncomponents, n)
+            tasks = [(self._evaluate_flat,
+                      (slots, arrays, outputs, start, stop, block_size))
+                     for start, stop in _split(n, threads, block_size)]
+            # no need for scratch arrays larger than the arrays:
+            block_size = max(1, min(block_size, n))
+        else:
+            # nditer handles broadcasting and conversion to float64,
+            # threads take contiguous ranges along the first axis:
+            arrays = [(i, numpy.broadcast_to(a, shape)) for i, a in arrays]
+            outputs = [out[index]
+                       for index in numpy.ndindex(*self.component_shape)]
+            tasks = [(self._evaluate_nditer,
+                      (slots, [(i, a[start:stop]) for i, a in arrays],
+                       [output[start:stop] for output in outputs],
+                       block_size))
+                     for start, stop in _split(shape[0], threads, 1)]
+        if workspace is None:
+            workspace = Workspace()
+        tasks = [(function, task_args +
+                  (workspace.scratch(i, self.nregisters + self.masked,
+                                     block_size),))
+                 for i, (function, task_args) in enumerate(tasks)]
+        if len(tasks) == 1:
+            function, task_args = tasks[0]
+            function(*task_args)
+        else:
+            executor = _thread_executor(len(tasks))
+            futures = [executor.submit(function, *task_args)
+                       for function, task_args in tasks]
+            for future in futures:
+                future.result()  # raises exceptions from the threads
+        return out
+
+    def _evaluate_flat(self, slots, arrays, outputs, start, stop,
+                       block_size, scratch):
+        """Evaluate elements start:stop of flat arrays, block by block."""
+        slots = list(slots)
+        for block_start in range(start, stop, block_size):
+            block_stop = min(block_start + block_size, stop)
+            for i, a in arrays:
+                slots[i] = a[block_start:block_stop]
+            for i in range(self.ncomponents):
+                slots[self.output_offset + i] = \
+                    outputs[i, block_start:block_stop]
+            self._run(slots, scratch, block_stop - block_start)
+
+    def _evaluate_nditer(self, slots, arrays, outputs, block_size, scratch):
+        """
+        Evaluate for (broadcast) arrays of any layout and data type,
+        block by block, with nditer buffers of block_size elements.
+        """
+        import numpy
+        slots = list(slots)
+        operands = [a for i, a in arrays] + outputs
+        it = numpy.nditer(
+            operands,
+            flags=['external_loop', 'buffered', 'zerosize_ok'],
+            op_flags=[['readonly']]*len(arrays) +
+                     [['writeonly']]*self.ncomponents,
+            op_dtypes=['float64']*len(operands),
+            casting='safe', buffersize=block_size)
+        with it:
+            for blocks in it:
+                n = blocks[0].shape[0]
+                if n > block_size:
+                    block_size = n
+                    scratch = [numpy.empty(n) for i in
+                               range(self.nregisters + self.masked)]
+                for (i, a), block in zip(arrays, blocks):
+                    slots[i] = block
+                for i in range(self.ncomponents):
+                    slots[self.output_offset + i] = blocks[len(arrays) + i]
+                self._run(slots, scratch, n)
+
+    def _run(self, slots, scratch, n):
+        """Run the code for one block of n elements."""
+        import numpy
+        offset = self.register_offset
+        for i in range(self.nregisters):
+            slots[offset + i] = scratch[i][:n]
+        if self.masked:
+            slots[self.mask_offset] = scratch[-1].view(numpy.bool_)[:n]
+        if self.conditional:
+            with numpy.errstate(divide='ignore', invalid='ignore',
+                                over='ignore'):
+                for ufunc, operands in self.code:
+                    ufunc(*[slots[i] for i in operands])
+            return
+        for ufunc, operands in self.code:
+            ufunc(*[slots[i] for i in operands])
+
+
+def _where_into(condition, value, alternative, mask, out):
+    """
+    Store numpy.where(condition, value, alternative) in out (without
+    temporary arrays), using the bool array mask for the condition.
+    """
+    import numpy
+    numpy.not_equal(condition, 0, out=mask)
+    if numpy.may_share_memory(out, value):  # out is value's register
+        numpy.logical_not(mask, out=mask)
+        numpy.copyto(out, alternative, where=mask)
+    else:
+        numpy.copyto(out, alternative)
+        numpy.copyto(out, value, where=mask)
+
+
+def _doctest():
+    # noinspection PyUnresolvedReferences
+    import doctest, StringFunction
+    return doctest.testmod(StringFunction)
+
+
+def _demo():
+    from math import pi
+    f = StringFunction('a+b*sin(x)', a=1, b=4)
+    print(f(2))
+    f.set_parameters(a=-1, b=pi)
+    print(f(1))
+    print('internals:', str(f), repr(f), f._lambda, f._prms)
+    f = StringFunction('amp*sin(a*t)*exp(-6.211*x)',
+                       independent_variables=('x', 't'))
+    f.set_parameters(amp=0.1, a=1)
+    print(f(0, pi / 2.0, a=2))
+    print('internals:', str(f), repr(f), f._lambda, f._prms)
+    print(f.C_code())
+    print(f.Cpp_code())
+    print(f.F77_code())
+
+
+def _benchmark_evaluate(n=10**7):
+    """
+    Compare StringFunction.evaluate (block by block) with evaluation
+    of whole arrays (vectorized mode): CPU time and peak memory
+    allocated by NumPy (measured by tracemalloc) in each call.
+    """
+    import time, tracemalloc, numpy
+    f = StringFunction('1+V*sin(w*x)*exp(-b*t)',
+                       independent_variables=('x', 't'),
+                       V=0.1, w=1, b=0.1, vectorized=True)
+    x = numpy.linspace(0, 1, n)
+    t = numpy.linspace(0, 2, n)
+    print('%s for arrays of length %d (%.0f MB):' % (f._f, n, x.nbytes/1e6))
+    for name, func in ('whole arrays', f), ('blocks', f.evaluate):
+        cpu_time = []
+        for i in range(4):  # the first call is a warm up
+            t0 = time.perf_counter()
+            func(x, t)
+            cpu_time.append(time.perf_counter() - t0)
+        cpu_time = min(cpu_time[1:])
+        tracemalloc.start()
+        func(x, t)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%-12s: %6.3f s, peak memory %7.1f MB' %
+              (name, cpu_time, peak/1e6))
 
 
 # simplified "pedagogical" versions from the
@@ -709,7 +4841,10 @@ class StringFunction_v5(StringFunction_v4):
                 del self._prms[v]
         except:
             pass
-        return StringFunction.__str__(self)
+        # parameter values substituted as in StringFunction.__str__
+        # (this class has no cache of the translated formula):
+        template = _template(self._f, tuple(self._prms))
+        return template.format(*map(str, self._prms.values()))
 
     def __repr__(self):
         # first remove indep. variables possibly inserted in self._prms
@@ -726,5 +4861,9 @@ class StringFunction_v5(StringFunction_v4):
 
 
 if __name__ == '__main__':
-    _doctest()
-    _demo()
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        _benchmark_evaluate()
+    else:
+        _doctest()
+        _demo()